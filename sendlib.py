@@ -30,12 +30,28 @@
 # POSSIBILITY OF SUCH DAMAGE.
 
 __version__ = '0.2.1'
-__all__ = ('SendlibError', 'ParseError', 'parse', '__version__')
+__all__ = ('SendlibError', 'ParseError', 'parse', 'encode_file',
+           'decode_file', '__version__')
 
+import array
+import ast
 import codecs
+import collections
+import contextlib
+import errno
+import itertools
+import mmap
+import multiprocessing
 import os
 import re
+import select
+import socket
+import stat
 import struct
+import threading
+import time
+import types
+from StringIO import StringIO
 
 PREFIX = {
     'str': 'S',
@@ -48,9 +64,45 @@ PREFIX = {
 }
 RPREFIX = dict((v, k) for k, v in PREFIX.items())
 LIST_PREFIX = 'L'
+# data of unknown length, as a series of length-prefixed
+# chunks, the last of which is empty
+CHUNKED_PREFIX = 'C'
+
+# the field types of values, by their python types, as
+# written without validation, and of field prefixes
+_VALUE_TYPES = {str: 'str', unicode: 'str', int: 'int', long: 'int',
+                float: 'float', bool: 'bool', type(None): 'nil',
+                list: 'list', tuple: 'list'}
+_PREFIX_TYPES = dict(RPREFIX)
+_PREFIX_TYPES.update({LIST_PREFIX: 'list', PREFIX['message']: 'msg',
+                      CHUNKED_PREFIX: 'chunked'})
+
+# validation levels of readers and writers
+_TRUSTED, _CHEAP, _FULL = range(3)
+_LEVELS = {'trusted': _TRUSTED, 'cheap': _CHEAP, 'full': _FULL}
+def _level(validate):
+    try:
+        return _LEVELS[validate]
+    except KeyError:
+        raise SendlibError('unknown validation level %s' % repr(validate))
+
+# the most released readers, and writers, kept by each message
+_POOL_SIZE = 8
+
+_SIZED_HEADER = struct.Struct('>cL')
+_LENGTH = struct.Struct('>L')
+_MAX_LENGTH = 4294967295
+_FLOAT = struct.Struct('>cd')
+# the struct format of each type of fixed width, with its prefix
+_FIXED_FORMATS = {'int': 'cL', 'float': 'cd', 'bool': 'cc'}
+
+# writes at least this large are buffered by reference, not copied
+_COPY_LIMIT = 16 * 1024
 
 class SendlibError(Exception): pass
 class ParseError(SendlibError): pass
+# raised when a message scanned in a buffer runs past its end
+class _Truncated(SendlibError): pass
 
 # a special marker, distinct from None
 class Nothing(object):
@@ -63,6 +115,8 @@ def typename(obj):
         return 'nil'
     elif isinstance(obj, Message):
         return 'msg (%s, %d)' % (obj.name, obj.version)
+    elif isinstance(obj, DataSource):
+        return 'data'
     return str(type(obj).__name__)
 
 class Writer(object):
@@ -74,13 +128,56 @@ class Writer(object):
     You ordinarily obtain a :class:`Writer` instance by calling
     :meth:`Message.writer` on a :class:`Message` instance, not
     by directly constructing one.
+
+    `validate` sets how much each write is checked:
+
+    * ``'full'``, the default, checks that each field is written
+      in order, and that each value, and each element of lists,
+      matches the field's types.
+    * ``'cheap'`` checks field order, but checks values only by
+      their Python type, and lists only by their first element.
+    * ``'trusted'`` checks nothing; values must be valid, and
+      nested messages given as :class:`Message` instances or
+      :class:`Nothing`. Writing an invalid value produces a
+      message which cannot be read.
+
+    Nested message writers have the same level. The checks are a
+    small part of the cost of writing most messages; the levels
+    save time chiefly on long ``many`` fields, whose elements
+    are otherwise checked one by one.
     """
 
-    __slots__ = ('message', 'stream', '_pos')
-    def __init__(self, message, stream):
+    __slots__ = ('message', 'stream', '_pos', '_source', '_level',
+                 '_chunk_writer')
+    def __init__(self, message, stream, validate='full'):
         self.message = message
         self.stream = stream
         self._pos = -1
+        self._source = None
+        self._level = _level(validate)
+        # the writer returned by data_writer, until it is closed
+        self._chunk_writer = None
+
+    def reset(self, stream=None):
+        """
+        Prepare to write another message, to `stream` if given,
+        or else to the same stream, discarding any partly
+        written one.
+        """
+        if stream is not None:
+            self.stream = stream
+        self._pos = -1
+        self._source = None
+        self._chunk_writer = None
+
+    def _check_closed(self):
+        # the data of a field written with data_writer
+        # must end before anything else is written
+        if not self._chunk_writer.closed:
+            raise SendlibError(
+                'the data writer for the last field must be closed '
+                'before the next field is written')
+        self._chunk_writer = None
 
     def _check_str(self, value):
         return type(value) in (str, unicode)
@@ -98,16 +195,12 @@ class Writer(object):
         return value is None
 
     def _check_data(self, value):
-        r = hasattr(value, 'read') and callable(value.read)
-        s = hasattr(value, 'seek') and callable(value.seek)
-        t = hasattr(value, 'tell') and callable(value.tell)
-        if not (r and s and t):
-            return False
-        value.seek(0, os.SEEK_END)
-        length = value.tell()
-        if length > 4294967295:
-            raise SendlibError(
-                'data length must be less than 4294967295 bytes')
+        if not isinstance(value, DataSource):
+            if not _is_data(value):
+                return False
+            value = DataSource(value)
+        # measured once, here, and kept for _write_data
+        self._source = value
         return True
 
     def _check(self, fieldname, value):
@@ -116,12 +209,6 @@ class Writer(object):
             raise SendlibError('attempt to write past end of message')
         field = self.message.fields[pos]
         if fieldname != field.name:
-            if 'nil' in field.types:
-                # FIXME: this is shady, a method named
-                # _check should not write anything
-                self._write_nil(None)
-                self._pos += 1
-                return self._check(fieldname, value)
             raise SendlibError(
                 'Attempting to access field "%s", but should be "%s"' %
                 (fieldname, field.name))
@@ -143,6 +230,22 @@ class Writer(object):
         raise SendlibError(
             '%s does not match field spec "%s"' % (repr(value), field.spec))
 
+    def _check_cheap(self, fieldname, value):
+        pos = max(0, self._pos)
+        if pos < len(self.message.fields):
+            field = self.message.fields[pos]
+            type_name = _VALUE_TYPES.get(value.__class__)
+            if fieldname != field.name:
+                pass
+            elif type_name == 'list':
+                if value and 'many ' + _VALUE_TYPES.get(
+                        value[0].__class__, '') in field.types:
+                    return type_name
+            elif type_name in field.types:
+                return type_name
+        # messages, data, and errors
+        return self._check(fieldname, value)
+
     def _check_list(self, field, sequence):
         # make sure the sequence has all
         # of the same type
@@ -150,7 +253,7 @@ class Writer(object):
             return 'list'
         types_found = set()
         for item in sequence:
-            types_found.add(typename(item))
+            types_found.add(_VALUE_TYPES.get(item.__class__) or typename(item))
         if len(types_found) > 1:
             raise SendlibError(
                 'sequence arguments to write must contain elements of '
@@ -198,42 +301,49 @@ class Writer(object):
                     'more than one message valid for field %s' % field.name)
             return 'msg'
 
+    # each value is written as at most one header write (prefix
+    # and any length, packed together) plus the caller's payload
+    # object itself, which is never copied
+
     def _write_str(self, value):
-        value = codecs.encode(value, 'utf-8')
-        self.stream.write(PREFIX['str'])
-        self.stream.write(struct.pack('>L', len(value)))
+        if type(value) is unicode:
+            value = codecs.encode(value, 'utf-8')
+        self.stream.write(_SIZED_HEADER.pack(PREFIX['str'], len(value)))
         self.stream.write(value)
 
     def _write_int(self, value):
-        self.stream.write(PREFIX['int'])
-        self.stream.write(struct.pack('>L', value))
+        self.stream.write(_SIZED_HEADER.pack(PREFIX['int'], value))
 
     def _write_bool(self, value):
-        self.stream.write(PREFIX['bool'])
-        self.stream.write('t' if value else 'f')
+        self.stream.write('Bt' if value else 'Bf')
 
     def _write_nil(self, value):
         self.stream.write(PREFIX['nil'])
 
     def _write_float(self, value):
-        self.stream.write(PREFIX['float'])
-        self.stream.write(struct.pack('>d', value))
+        self.stream.write(_FLOAT.pack(PREFIX['float'], value))
 
     def _write_data(self, value):
-        value.seek(0, os.SEEK_END)
-        length = value.tell()
-        value.seek(0, 0)
+        source, self._source = self._source, None
+        if source is None or value is not source and value is not source.obj:
+            # list items are not checked one by one
+            if isinstance(value, DataSource):
+                source = value
+            else:
+                source = DataSource(value)
 
-        self.stream.write(PREFIX['data'])
-        self.stream.write(struct.pack('>L', length))
+        if source.length is None or source.length > _MAX_LENGTH:
+            self.stream.write(CHUNKED_PREFIX)
+            for chunk in source._chunks():
+                if chunk:
+                    self.stream.write(_LENGTH.pack(len(chunk)))
+                    self.stream.write(chunk)
+            self.stream.write(_LENGTH.pack(0))
+            return
 
-        sofar = 0
-        size = 256 * 1024
-        while sofar < length:
-            amount = min(size, (length - sofar))
-            buf = value.read(amount)
-            self.stream.write(buf)
-            sofar += len(buf)
+        self.stream.write(_SIZED_HEADER.pack(PREFIX['data'], source.length))
+        for chunk in source._chunks():
+            self.stream.write(chunk)
 
     def _write_msg(self, value):
         field = self.message.fields[self._pos]
@@ -250,13 +360,14 @@ class Writer(object):
             message = self.message.registry.get_message(
                 m.group(1), int(m.group(2)))
         writer = message.writer(self.stream)
+        writer._level = self._level
         return writer
 
     def _write_list(self, value):
-        self.stream.write('L')
-        self.stream.write(struct.pack('>L', len(value)))
+        self.stream.write(_SIZED_HEADER.pack(LIST_PREFIX, len(value)))
         if len(value):
-            inner_type = typename(value[0])
+            inner_type = _VALUE_TYPES.get(value[0].__class__) or \
+                typename(value[0])
             if _msg.match(inner_type):
                 writer = self._write_msg
             else:
@@ -268,6 +379,23 @@ class Writer(object):
         else:
             return ()
 
+    def _write_header(self):
+        self.stream.write(self.message._header())
+        self._pos = 0
+
+    def _skip_nils(self, fieldname):
+        # if `fieldname` follows the next field, and all the
+        # fields between allow nil, write their nils at once
+        pos = max(0, self._pos)
+        target = self.message._position(fieldname)
+        if target is None or not pos < target <= self.message._nil_run(pos):
+            # _check raises the error
+            return
+        if self._pos == -1:
+            self._write_header()
+        self.stream.write(PREFIX['nil'] * (target - pos))
+        self._pos = target
+
     def write(self, fieldname, value=Nothing):
         """
         Write the `value` to the stream, after verifying that
@@ -288,22 +416,331 @@ class Writer(object):
         :class:`Message`, in which case a new
         :class:`Writer` is returned.
         """
-        type = self._check(fieldname, value)
+        if self._chunk_writer is not None:
+            self._check_closed()
+        pos = max(0, self._pos)
+        fields = self.message.fields
+        if pos < len(fields) and fields[pos].name != fieldname:
+            self._skip_nils(fieldname)
+        if self._level == _FULL:
+            type = self._check(fieldname, value)
+        elif self._level == _CHEAP:
+            type = self._check_cheap(fieldname, value)
+        elif value is Nothing or isinstance(value, Message):
+            type = 'msg'
+        else:
+            type = _VALUE_TYPES.get(value.__class__, 'data')
         if self._pos == -1:
-            # write header
-            self.stream.write('M')
-            self._write_str(self.message.name)
-            self._write_int(self.message.version)
-            self._pos = 0
+            self._write_header()
 
         writer = getattr(self, '_write_' + type)
         out = writer(value)
         self._pos += 1
         return out
 
+    def write_all(self, values, cache=None):
+        """
+        Write all the remaining fields of the message from `values`,
+        either a dictionary mapping field names to values or an
+        instance of :meth:`Message.record_class`, as described for
+        :meth:`Message.encode`. Each run of absent fields which allow
+        ``nil`` is written at once.
+
+        Nested messages are written from an explicit stack rather
+        than by recursion, so they may be nested to any depth.
+
+        If `cache`, an :class:`EncodeCache`, is given, the message
+        (if nothing of it is written yet) and each nested message
+        are written from it when their values were written before,
+        and otherwise added to it.
+        """
+        # each entry is a writer, its values, and, while it is
+        # written to a buffer for the cache, the stream to copy
+        # that to; a writer resumes from its position once its
+        # nested messages, pushed above it, are written
+        if self._chunk_writer is not None:
+            self._check_closed()
+        stack = [(self, values, None)]
+        while stack:
+            writer, values, out_stream = stack.pop()
+            if writer._pos == -1 and cache is not None and \
+               cache._caches(writer.message):
+                encoded = cache._get(writer.message, values)
+                if encoded is not None:
+                    writer.stream.write(encoded)
+                    writer._pos = len(writer.message.fields)
+                    if writer is not self:
+                        writer.message.release(writer)
+                    continue
+                out_stream = writer.stream
+                writer.stream = StringIO()
+            if writer._pos == -1 and not writer._write_fixed(values):
+                writer._write_header()
+            fields = writer.message.fields
+            nils = 0
+            while writer._pos + nils < len(fields):
+                field = fields[writer._pos + nils]
+                value = _field_value(field, values)
+                if value is None and 'nil' in field.types:
+                    nils += 1
+                    continue
+                if nils:
+                    writer.stream.write(PREFIX['nil'] * nils)
+                    writer._pos += nils
+                    nils = 0
+                if writer._write_fixed(values):
+                    continue
+                if isinstance(value, (dict, Record)):
+                    out = writer.write(field.name,
+                                       _nested_message(field, value))
+                    stack.append((writer, values, out_stream))
+                    stack.append((out, value, None))
+                    break
+                elif type(value) in (list, tuple) and value and \
+                     isinstance(value[0], (dict, Record)):
+                    subwriters = writer.write(field.name, [
+                        _nested_message(field, item, many=True)
+                        for item in value])
+                    stack.append((writer, values, out_stream))
+                    stack.extend(
+                        (subwriter, item, None) for subwriter, item
+                        in reversed(zip(subwriters, value)))
+                    break
+                else:
+                    writer.write(field.name, value)
+            else:
+                if nils:
+                    writer.stream.write(PREFIX['nil'] * nils)
+                    writer._pos += nils
+                if out_stream is not None:
+                    encoded = writer.stream.getvalue()
+                    cache._put(writer.message, values, encoded)
+                    writer.stream = out_stream
+                    out_stream.write(encoded)
+                if writer is not self:
+                    writer.message.release(writer)
+
+    def _write_fixed(self, values):
+        # write the run of fixed-width fields at the current
+        # position (with the header, if not yet written) from
+        # `values` with a single pack, if there is such a run and
+        # its values are all of their fields' types
+        run = self.message._fixed_run(self._pos)
+        if run is None:
+            return False
+        encoded = run.pack(values)
+        if encoded is None:
+            return False
+        self.stream.write(encoded)
+        self._pos = run.end
+        return True
+
+    def data_writer(self, fieldname):
+        """
+        Begin writing the ``data`` field `fieldname`, whose length
+        need not be known in advance, and return a file-like object
+        with ``write(str)`` and ``close()`` methods to write its
+        contents. It must be closed before the next field is
+        written. As with :meth:`write`, `fieldname` must be the
+        correct next field in the message format; writing another
+        field before it is closed raises :class:`SendlibError`.
+        """
+        if self._chunk_writer is not None:
+            self._check_closed()
+        self._skip_nils(fieldname)
+        self._check(fieldname, DataSource(()))
+        self._source = None
+        if self._pos == -1:
+            self._write_header()
+        self.stream.write(CHUNKED_PREFIX)
+        self._pos += 1
+        self._chunk_writer = _ChunkWriter(self.stream)
+        return self._chunk_writer
+
     def flush(self):
         self.stream.flush()
 
+class _ChunkWriter(object):
+    # the file-like object returned by Writer.data_writer; writes
+    # smaller than _COPY_LIMIT are collected into larger chunks
+    __slots__ = ('stream', '_pending', '_size', 'closed')
+    def __init__(self, stream):
+        self.stream = stream
+        self._pending = []
+        self._size = 0
+        self.closed = False
+
+    def _send(self):
+        if self._size:
+            self.stream.write(_LENGTH.pack(self._size))
+            self.stream.write(''.join(self._pending))
+            self._pending = []
+            self._size = 0
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('I/O operation on closed file')
+        if len(data) >= _COPY_LIMIT:
+            self._send()
+            self.stream.write(_LENGTH.pack(len(data)))
+            self.stream.write(data)
+        elif data:
+            self._pending.append(data)
+            self._size += len(data)
+            if self._size >= _COPY_LIMIT:
+                self._send()
+
+    def flush(self):
+        self._send()
+
+    def close(self):
+        if not self.closed:
+            self._send()
+            self.stream.write(_LENGTH.pack(0))
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def _is_data(value):
+    # values which are written to data fields without being
+    # wrapped in a DataSource by the caller
+    if isinstance(value, (bytearray, memoryview, types.GeneratorType)):
+        return True
+    return all(callable(getattr(value, method, None))
+               for method in ('read', 'seek', 'tell'))
+
+class DataSource(object):
+    """
+    :class:`DataSource` is the value of a ``data`` field to be
+    written: a length, and `obj` from which that many bytes are
+    read. `obj` may be:
+
+    * a file-like object. If it is seekable (not merely having
+      ``seek`` and ``tell`` methods, as the file objects of pipes
+      do), and `length` is not given, it is measured by seeking to its
+      end, and written from its beginning. Otherwise, it is read
+      from its current position, and need not be seekable, as for
+      pipes or sockets.
+    * a :class:`str`, :class:`bytearray` or :class:`memoryview`,
+      which is written whole.
+    * an integer file descriptor, which is read from its current
+      offset. If `length` is not given and it is a regular file,
+      it is read to its end.
+    * any other iterable of strings.
+
+    If `length` is given, exactly that many bytes must be read
+    from `obj`. Otherwise, for unseekable streams and iterables,
+    `length` is ``None``, and the data is written in chunks, each
+    preceded by its length, until `obj` is exhausted. Data of more
+    than 4294967295 bytes is always written in chunks.
+
+    :class:`Writer` wraps seekable file-like objects, byte arrays,
+    memory views and generators given for ``data`` fields itself,
+    so this is needed only for other sources. Each
+    :class:`DataSource` should be written at most once.
+    """
+
+    __slots__ = ('obj', 'length')
+    def __init__(self, obj, length=None):
+        self.obj = obj
+        if isinstance(obj, (str, bytearray, memoryview)):
+            length = len(obj)
+        elif isinstance(obj, (int, long)):
+            if length is None:
+                info = os.fstat(obj)
+                if stat.S_ISREG(info.st_mode):
+                    length = info.st_size - os.lseek(obj, 0, os.SEEK_CUR)
+        elif callable(getattr(obj, 'read', None)):
+            if length is None and _is_data(obj):
+                try:
+                    obj.seek(0, os.SEEK_END)
+                except (IOError, OSError):
+                    # pipes' file objects have seek methods
+                    # which fail
+                    pass
+                else:
+                    length = obj.tell()
+                    obj.seek(0, 0)
+        elif not hasattr(obj, '__iter__'):
+            raise SendlibError('%s is not a valid data source' % repr(obj))
+        self.length = length
+
+    def __repr__(self):
+        return 'DataSource(%r, %r)' % (self.obj, self.length)
+
+    def _chunks(self, size=256 * 1024):
+        # yield the contents of the source, verifying the length
+        obj, remaining = self.obj, self.length
+        if isinstance(obj, str):
+            if remaining:
+                yield obj
+            return
+        elif isinstance(obj, (bytearray, memoryview)):
+            view = memoryview(obj)
+            for start in xrange(0, remaining, size):
+                yield view[start:start + size].tobytes()
+            return
+        elif isinstance(obj, (int, long)):
+            read = lambda amount: os.read(obj, amount)
+        elif callable(getattr(obj, 'read', None)):
+            read = obj.read
+        else:
+            for chunk in obj:
+                if remaining is not None:
+                    remaining -= len(chunk)
+                    if remaining < 0:
+                        raise SendlibError(
+                            'data source is longer than %d bytes'
+                            % self.length)
+                yield chunk
+            if remaining:
+                raise SendlibError('data source is shorter than %d bytes'
+                                   % self.length)
+            return
+
+        while remaining is None or remaining:
+            amount = size if remaining is None else min(size, remaining)
+            chunk = read(amount)
+            if not chunk:
+                if remaining is None:
+                    return
+                raise SendlibError('data source is shorter than %d bytes'
+                                   % self.length)
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+# the largest read made to fill the line buffer of a Data
+_BLOCK_SIZE = 64 * 1024
+
+# discarded reads land here when skipping
+# over fields in unseekable streams
+_scratch = bytearray(64 * 1024)
+def _discard(stream, amount):
+    seekable = getattr(stream, 'seekable', None)
+    if seekable() if seekable else hasattr(stream, 'seek'):
+        try:
+            stream.seek(amount, os.SEEK_CUR)
+            return
+        except (IOError, OSError):
+            pass
+    readinto = getattr(stream, 'readinto', None) or \
+        getattr(stream, 'recv_into', None)
+    view = memoryview(_scratch)
+    while amount > 0:
+        size = min(amount, len(_scratch))
+        if readinto:
+            got = readinto(view[:size])
+        else:
+            got = len(stream.read(size))
+        if not got:
+            raise SendlibError('unexpected end of stream')
+        amount -= got
+
 class Data(object):
     """
     :class:`Data` is a limited file-like object for reading
@@ -311,12 +748,59 @@ class Data(object):
     it does not support :meth:`seek`, as ``sendblib`` does
     not require that the underlying stream support full
     bi-directional seeking.
+
+    For data written in chunks, :attr:`length` is ``None`` until
+    the end of the data has been read.
+
+    Iterating over a :class:`Data` yields its lines, as for files.
     """
-    __slots__ = ('length', 'stream', '_pos')
+    __slots__ = ('length', 'stream', '_pos', '_buf', '_bufpos', '_then')
     def __init__(self, length, stream):
         self.length = length
         self.stream = stream
         self._pos = 0
+        # lines are read from the stream in blocks of up to
+        # _BLOCK_SIZE bytes, never past the end of the data
+        self._buf = ''
+        self._bufpos = 0
+        # the Reader waiting for the end of the data, if any
+        self._then = None
+
+    def _available(self):
+        # the number of bytes which may be read from the
+        # stream before the end of the data or chunk
+        return self.length - self._pos
+
+    def _consume(self, amount):
+        self._pos += amount
+        if self._pos == self.length and self._then is not None:
+            self._ended()
+
+    def _ended(self):
+        # the stream is past the end of the data
+        then, self._then = self._then, None
+        then._done()
+
+    def _fill(self):
+        # refill the empty line buffer, returning
+        # False at the end of the data
+        amount = self._available()
+        if not amount:
+            return False
+        self._buf = self.stream.read(min(amount, _BLOCK_SIZE))
+        self._bufpos = 0
+        self._consume(len(self._buf))
+        return bool(self._buf)
+
+    def _buffered(self, size):
+        # return and consume up to `size` (if
+        # positive) bytes of the line buffer
+        start = self._bufpos
+        if size > 0:
+            self._bufpos = min(len(self._buf), start + size)
+        else:
+            self._bufpos = len(self._buf)
+        return self._buf[start:self._bufpos]
 
     def read(self, size=None):
         """
@@ -325,15 +809,47 @@ class Data(object):
         many as are available. If past the end of the stream,
         return an empty string.
         """
-        if self._pos >= self.length:
-            return ''
-        if size:
-            amount = min(size, (self.length - self._pos))
-        else:
-            amount = self.length - self._pos
-        out = self.stream.read(amount)
-        self._pos += len(out)
-        return out
+        size = size or -1
+        parts = []
+        if self._bufpos < len(self._buf):
+            parts.append(self._buffered(size))
+            if size > 0:
+                size -= len(parts[0])
+        while size:
+            amount = self._available()
+            if not amount:
+                break
+            if size > 0:
+                amount = min(size, amount)
+                size -= amount
+            out = self.stream.read(amount)
+            self._consume(len(out))
+            parts.append(out)
+            if len(out) < amount:
+                break
+        return ''.join(parts)
+
+    def readinto(self, buf):
+        """
+        Read up to ``len(buf)`` bytes into `buf`, a writable buffer
+        such as a :class:`bytearray`, and return the number of
+        bytes read, which is 0 only at the end of the data.
+        """
+        view = memoryview(buf)
+        got = len(self._buffered(len(view)))
+        view[:got] = self._buf[self._bufpos - got:self._bufpos]
+        amount = min(len(view) - got, self._available())
+        if amount:
+            readinto = getattr(self.stream, 'readinto', None)
+            if readinto:
+                out = readinto(view[got:got + amount])
+            else:
+                out = self.stream.read(amount)
+                view[got:got + len(out)] = out
+                out = len(out)
+            self._consume(out)
+            got += out
+        return got
 
     def readline(self, size=None):
         """
@@ -345,15 +861,77 @@ class Data(object):
         The last line read may not include a trailing new line
         character if one was not present in the underlying stream.
         """
-        if self._pos >= self.length:
-            return ''
-        if size:
-            amount = min(size, (self.length - self._pos))
-        else:
-            amount = self.length - self._pos
-        out = self.stream.readline(amount)
-        self._pos += len(out)
-        return out
+        size = size or -1
+        parts = []
+        while size:
+            if self._bufpos == len(self._buf) and not self._fill():
+                break
+            end = self._buf.find('\n', self._bufpos)
+            if end == -1:
+                part = self._buffered(size)
+            else:
+                stop = end + 1 - self._bufpos
+                part = self._buffered(stop if size < 0 else min(size, stop))
+            parts.append(part)
+            if size > 0:
+                size -= len(part)
+            if part.endswith('\n'):
+                break
+        return ''.join(parts)
+
+    def readlines(self, sizehint=None):
+        """
+        Read lines until the end of the data, or until at least
+        `sizehint` bytes have been read, and return them as a list.
+        """
+        lines = []
+        total = 0
+        for line in self:
+            lines.append(line)
+            total += len(line)
+            if sizehint and total >= sizehint:
+                break
+        return lines
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def iter_chunks(self, size=_BLOCK_SIZE):
+        """
+        Return an iterator over the remaining data, in strings of
+        at most `size` bytes.
+        """
+        while True:
+            chunk = self.read(size)
+            if not chunk:
+                return
+            yield chunk
+
+    def copy_to(self, *sinks, **kwargs):
+        """
+        Read the remaining data, in strings of at most `chunk_size`
+        bytes (a keyword argument), writing each string in turn to
+        every one of `sinks`, and return the number of bytes copied.
+        Sinks may be any objects with a ``write(str)`` method, such
+        as files, sockets' file objects, or the file-like objects
+        returned by :meth:`Writer.data_writer`, when forwarding data
+        to another message.
+        """
+        chunk_size = kwargs.pop('chunk_size', _BLOCK_SIZE)
+        if kwargs:
+            raise TypeError('unexpected keyword arguments %s' %
+                            ', '.join(sorted(kwargs)))
+        writes = [sink.write for sink in sinks]
+        total = 0
+        for chunk in self.iter_chunks(chunk_size):
+            for write in writes:
+                write(chunk)
+            total += len(chunk)
+        return total
 
     def skip(self):
         """
@@ -361,15 +939,125 @@ class Data(object):
         area in the stream. This allows the next call to
         :meth:`Reader.read` to succeed, as though all the
         data had been read by the application.
+
+        The underlying stream is seeked, if possible, or otherwise
+        read into a reusable buffer, so skipping uses a constant
+        amount of memory however long the data is.
         """
-        self.stream.seek(self.bytes_remaining(), os.SEEK_CUR)
-        self._pos = self.length
+        self._buf = ''
+        self._bufpos = 0
+        while True:
+            amount = self._available()
+            if not amount:
+                break
+            _discard(self.stream, amount)
+            self._consume(amount)
 
     def bytes_remaining(self):
         """
-        Return the number of bytes remaining.
+        Return the number of bytes remaining. For chunked data,
+        return the number remaining in the current chunk, which
+        is 0 only at the end of the data.
         """
-        return self.length - self._pos
+        return len(self._buf) - self._bufpos + self._available()
+
+class _ChunkedData(Data):
+    # Data of unknown length, read chunk by chunk
+    __slots__ = ('_chunk', )
+    def __init__(self, stream):
+        Data.__init__(self, None, stream)
+        self._chunk = 0
+
+    def _available(self):
+        if not self._chunk and self.length is None:
+            header = self.stream.read(4)
+            if len(header) < 4:
+                raise SendlibError('unexpected end of stream')
+            self._chunk = _LENGTH.unpack(header)[0]
+            if not self._chunk:
+                self.length = self._pos
+                if self._then is not None:
+                    self._ended()
+        return self._chunk
+
+    def _consume(self, amount):
+        self._pos += amount
+        self._chunk -= amount
+
+class _BufferStream(object):
+    # a minimal read-only file-like view of buf[start:end], for
+    # reading messages out of memory-mapped files without copying
+    # more than each read asks for
+    __slots__ = ('buf', 'start', 'end', 'pos')
+    def __init__(self, buf, start=0, end=None):
+        self.buf = buf
+        self.start = start
+        self.end = len(buf) if end is None else end
+        self.pos = start
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = self.end
+        else:
+            end = min(self.end, self.pos + size)
+        out = self.buf[self.pos:end]
+        self.pos = max(self.pos, end)
+        return out
+
+    def readline(self, size=-1):
+        end = self.end
+        if size is not None and size >= 0:
+            end = min(end, self.pos + size)
+        newline = self.buf.find('\n', self.pos, end)
+        if newline != -1:
+            end = newline + 1
+        return self.read(end - self.pos)
+
+    def seek(self, offset, whence=0):
+        if whence == os.SEEK_CUR:
+            offset += self.pos - self.start
+        elif whence == os.SEEK_END:
+            offset += self.end - self.start
+        self.pos = self.start + max(0, offset)
+
+    def tell(self):
+        return self.pos - self.start
+
+class _StreamWindow(object):
+    # a read-only file-like view of stream[start:end] which seeks
+    # before each read, and afterwards returns to `rest`
+    __slots__ = ('stream', 'start', 'end', 'pos', 'rest')
+    def __init__(self, stream, start, end, rest):
+        self.stream = stream
+        self.start = start
+        self.end = end
+        self.pos = start
+        self.rest = rest
+
+    def _read(self, method, size):
+        if size is None or size < 0 or self.pos + size > self.end:
+            size = self.end - self.pos
+        self.stream.seek(self.pos, 0)
+        out = method(size)
+        self.pos += len(out)
+        self.stream.seek(self.rest, 0)
+        return out
+
+    def read(self, size=-1):
+        return self._read(self.stream.read, size)
+
+    def readline(self, size=-1):
+        return self._read(self.stream.readline, size)
+
+    def seek(self, offset, whence=0):
+        if whence == os.SEEK_CUR:
+            offset += self.pos - self.start
+        elif whence == os.SEEK_END:
+            offset += self.end - self.start
+        self.pos = self.start + max(0, offset)
+
+    def tell(self):
+        return self.pos - self.start
 
 class Reader(object):
     """
@@ -381,23 +1069,105 @@ class Reader(object):
     You ordinarily obtain a :class:`Reader` instance by
     calling :meth:`Message.reader` on a :class:`Message`
     instance, not by directly constructing one.
+
+    If `skip_data` is true, reading or skipping a field while
+    the :class:`Data` returned for a preceding ``data`` field
+    has only been partly read first skips the rest of it, as
+    with :meth:`Data.skip`; otherwise, this raises an exception.
+
+    If the stream holds a message with the same name as `message`
+    but another version, which is also in the registry, it is read
+    as a message of `message`'s format: fields which `message` no
+    longer has are skipped, and fields it has added (which must
+    have defaults, or allow ``nil``) read as their defaults. The
+    fields the two versions share must be in the same order.
+
+    `validate` sets how much is checked when reading. With
+    ``'full'``, the default, the message name and version and
+    the name and type of each field are checked. With ``'cheap'``,
+    the header and field types are checked as well, but only the
+    first element of a list. With ``'trusted'``, the message
+    header is skipped unread, and field names and types are not
+    checked; the stream must hold a valid message of this format.
+    These apply to sequential reads only, and, as for
+    :class:`Writer`, save little time except on long ``many``
+    fields, whose element types are not checked when trusted.
+
+    If `random_access` is true, `stream` must be seekable, and
+    fields may be read in any order, and more than once. On the
+    first read, the message is scanned (seeking past strings and
+    ``data``) to find the offset of each field; each read then
+    seeks directly to its field, and leaves the stream positioned
+    after the end of the message.
     """
 
-    __slots__ = ('message', 'stream', '_pos', '_data', '_peek')
-    def __init__(self, message, stream):
+    __slots__ = ('message', 'stream', '_pos', '_data', '_peek', '_random',
+                 '_offsets', '_end', '_skip_data', '_transcoder', '_level',
+                 '_then', '_pending')
+    def __init__(self, message, stream, random_access=False, skip_data=False,
+                 validate='full'):
         self.message = message
         self.stream = stream
         self._pos = -1
         self._data = None
         self._peek = None
+        self._random = random_access
+        self._offsets = None
+        self._end = None
+        self._skip_data = skip_data
+        self._transcoder = None
+        self._level = _level(validate)
+        # the reader of the enclosing message, waiting for this
+        # one to end, and whether this one waits on the last of
+        # a list of nested messages not yet read
+        self._then = None
+        self._pending = False
+
+    def reset(self, stream=None):
+        """
+        Prepare to read another message, from `stream` if given,
+        or else from the same stream, which must be positioned at
+        its start. Any part of the current message not yet read
+        is not skipped.
+        """
+        if stream is not None:
+            self.stream = stream
+        self._pos = -1
+        self._data = None
+        self._peek = None
+        self._offsets = None
+        self._end = None
+        self._transcoder = None
+        self._then = None
+        self._pending = False
 
-    def _check(self, fieldname):
+    def _field(self, fieldname):
         pos = max(0, self._pos)
+        if pos >= len(self.message.fields):
+            raise SendlibError('attempt to read past end of message')
         field = self.message.fields[pos]
         if field.name != fieldname:
             raise SendlibError(
                 'Attempting to access field "%s", but should be "%s"' %
                 (fieldname, field.name))
+        return field
+
+    def _check(self, fieldname):
+        field = self._field(fieldname)
+        if self._peek == LIST_PREFIX:
+            for type_name in field.types:
+                if _many.match(type_name):
+                    return 'list'
+            raise SendlibError(
+                'field type "list" incorrect for field %s' % field)
+        if self._peek == PREFIX['message']:
+            for type_name in field.types:
+                if _msg.match(type_name):
+                    return 'msg'
+            raise SendlibError(
+                'field type "msg" incorrect for field %s' % field)
+        if self._peek == CHUNKED_PREFIX and 'data' in field.types:
+            return 'chunked'
         try:
             type = RPREFIX[self._peek]
         except KeyError:
@@ -435,6 +1205,78 @@ class Reader(object):
         self._data = Data(length, self.stream)
         return self._data
 
+    def _read_chunked(self):
+        self._data = _ChunkedData(self.stream)
+        return self._data
+
+    def _read_header(self):
+        # reads the name and version following an
+        # already-consumed message prefix
+        if PREFIX['str'] != self.stream.read(1):
+            raise SendlibError('Invalid message format')
+        name = self._read_str()
+        if PREFIX['int'] != self.stream.read(1):
+            raise SendlibError('Invalid message format')
+        version = self._read_int()
+        return name, version
+
+    def _read_submessage(self, types):
+        name, version = self._read_header()
+        type_name = 'msg (%s, %d)' % (name, version)
+        if type_name not in types:
+            raise SendlibError(
+                'message (%s, %d) not valid for field %s' %
+                (name, version, self.message.fields[self._pos].name))
+        reader = self.message.registry[(name, version)].reader(
+            self.stream, skip_data=self._skip_data)
+        reader._level = self._level
+        reader._pos = 0
+        return reader
+
+    def _read_msg(self):
+        return self._read_submessage(self.message.fields[self._pos].types)
+
+    def _read_list(self):
+        field = self.message.fields[self._pos]
+        inner_types = []
+        for type_name in field.types:
+            many = _many.match(type_name)
+            if many:
+                inner_types.append(many.group(1))
+        length = self._read_int()
+        if length and _msg.match(inner_types[0]):
+            return self._iter_messages(length, inner_types)
+        out = []
+        read = self.stream.read
+        # as when writing, cheap checks only the first element
+        checked = length
+        if self._level == _TRUSTED:
+            checked = 0
+        elif self._level == _CHEAP:
+            checked = min(length, 1)
+        for i in xrange(checked):
+            type = RPREFIX.get(read(1))
+            if type not in inner_types:
+                raise SendlibError(
+                    'list element type "%s" incorrect for field %s' %
+                    (type, field))
+            out.append(getattr(self, '_read_' + type)())
+        for i in xrange(checked, length):
+            out.append(getattr(self, '_read_' + RPREFIX[read(1)])())
+        return out
+
+    def _iter_messages(self, length, types):
+        # each nested message must be fully read before
+        # the next one's header is available in the stream
+        for i in xrange(length):
+            if PREFIX['message'] != self.stream.read(1):
+                raise SendlibError('Invalid message format')
+            reader = self._read_submessage(types)
+            if i == length - 1 and self._pending:
+                self._pending = False
+                self._wait(reader)
+            yield reader
+
     def read(self, fieldname):
         """
         Read the next field from the stream. `fieldname` is used
@@ -445,38 +1287,504 @@ class Reader(object):
 
         Returns a Python object of the correct type, depending on
         the type present in the stream. If the type is ``data``,
-        returns a :class:`Data` file-like object.
+        returns a :class:`Data` file-like object. Nested messages
+        are returned as a new :class:`Reader`, and ``many`` fields
+        as a list (or, for nested messages, an iterator of
+        :class:`Reader` objects, each of which must be fully read
+        before advancing to the next).
+
+        In random access mode, `fieldname` may name any field, and
+        nested messages are returned as random access
+        :class:`Reader` objects (as a list, for ``many`` fields).
         """
-        if self._pos == -1:
-            self._pos = 0
-            if PREFIX['message'] != self.stream.read(1):
-                raise SendlibError('Invalid message format')
-            if PREFIX['str'] != self.stream.read(1):
-                raise SendlibError('Invalid message format')
-            name = self._read_str()
-            if PREFIX['int'] != self.stream.read(1):
-                raise SendlibError('Invalid message format')
-            version = self._read_int()
-            if name != self.message.name or version != self.message.version:
-                raise SendlibError(
-                    'Reader for %s cannot read message of type (%s, %d)'
-                    % (self.message, name, version))
+        if self._random:
+            return self._read_random(fieldname)
+        typename = self._begin(fieldname)
+        if typename is None:
+            value = self._transcoder.defaults[self._pos]
+        else:
+            value = getattr(self, '_read_' + typename)()
+        self._advance(value)
+        return value
 
+    def _advance(self, value=None):
+        self._pos += 1
+        self._peek = None
+        if self._pos == len(self.message.fields) and (
+                self._then is not None or
+                self._transcoder is not None and self._transcoder.tail):
+            self._wait(value)
+
+    def _wait(self, value):
+        # the last field was read as `value`; once the stream is
+        # past its end, the message is finished
+        if isinstance(value, Reader) and value.message.fields:
+            value._then = self
+        elif isinstance(value, Data) and value.length != value._pos:
+            value._then = self
+        elif isinstance(value, types.GeneratorType):
+            self._pending = True
+        else:
+            self._done()
+
+    def _done(self):
+        # the last field is finished: skip the fields of the
+        # message's version which follow it, then finish the
+        # enclosing message, if it waits on this one
+        if self._transcoder is not None:
+            for i in xrange(self._transcoder.tail):
+                self._skip_value(self.stream.read(1))
+        if self._then is not None:
+            then, self._then = self._then, None
+            then._done()
+
+    def _scan_offsets(self):
+        # record the offset of each field of the
+        # message beginning at the current position
+        if PREFIX['message'] != self.stream.read(1):
+            raise SendlibError('Invalid message format')
+        name, version = self._read_header()
+        if name != self.message.name or version != self.message.version:
+            raise SendlibError(
+                'Reader for %s cannot read message of type (%s, %d)'
+                % (self.message, name, version))
+        self._offsets = array.array('L')
+        for field in self.message.fields:
+            self._offsets.append(self.stream.tell())
+            self._skip_value(self.stream.read(1))
+        self._end = self.stream.tell()
+
+    def _random_submessage(self, types):
+        start = self.stream.tell()
+        if PREFIX['message'] != self.stream.read(1):
+            raise SendlibError('Invalid message format')
+        name, version = self._read_header()
+        if 'msg (%s, %d)' % (name, version) not in types:
+            raise SendlibError(
+                'message (%s, %d) not valid for field %s' %
+                (name, version, self.message.fields[self._pos].name))
+        reader = Reader(self.message.registry[(name, version)], self.stream,
+                        random_access=True)
+        self.stream.seek(start, 0)
+        reader._scan_offsets()
+        return reader
+
+    def _read_random(self, fieldname):
+        if self._offsets is None:
+            self._scan_offsets()
+        pos = self.message._position(fieldname)
+        if pos is None:
+            raise SendlibError('%s has no field "%s"' %
+                               (self.message, fieldname))
+        self._pos = pos
+        self.stream.seek(self._offsets[pos], 0)
+        self._peek = self.stream.read(1)
+        typename = self._check(fieldname)
+        field = self.message.fields[pos]
+        if typename == 'data':
+            length = self._read_int()
+            start = self.stream.tell()
+            value = Data(length, _StreamWindow(
+                self.stream, start, start + length, self._end))
+        elif typename == 'chunked':
+            start = self.stream.tell()
+            end = self._offsets[pos + 1] \
+                if pos + 1 < len(self._offsets) else self._end
+            value = _ChunkedData(
+                _StreamWindow(self.stream, start, end, self._end))
+        elif typename == 'msg':
+            self.stream.seek(-1, os.SEEK_CUR)
+            value = self._random_submessage(field.types)
+        elif typename == 'list' and field._message_types(many=True):
+            types = [m.group(1) for m in map(_many.match, field.types) if m]
+            value = []
+            for i in xrange(self._read_int()):
+                value.append(self._random_submessage(types))
+                self.stream.seek(value[-1]._end, 0)
+        else:
+            value = getattr(self, '_read_' + typename)()
+        self._peek = None
+        self.stream.seek(self._end, 0)
+        return value
+
+    def skip(self, fieldname):
+        """
+        Advance past the next field without decoding it. As with
+        :meth:`read`, `fieldname` must name the next field in the
+        message definition.
+
+        Strings and ``data`` are skipped by seeking the underlying
+        stream, if it supports seeking, or by discarding their
+        contents into a reusable buffer otherwise; nested messages
+        and ``many`` fields are skipped element by element.
+
+        In random access mode, :meth:`skip` has no effect.
+        """
+        if self._random:
+            return
+        if self._begin(fieldname) is not None:
+            self._skip_value(self._peek)
+        self._advance()
+
+    def skip_to(self, fieldname):
+        """
+        Skip (as with :meth:`skip`) all fields preceding the field
+        named `fieldname`, so that it may be read next. Raises
+        :class:`SendlibError`, without skipping any fields, if
+        `fieldname` is not the name of the next or a later field.
+
+        In random access mode, :meth:`skip_to` has no effect.
+        """
+        if self._random:
+            return
+        pos = max(0, self._pos)
+        names = [field.name for field in self.message.fields[pos:]]
+        if fieldname not in names:
+            raise SendlibError(
+                'field "%s" does not follow the current position' %
+                fieldname)
+        for name in names[:names.index(fieldname)]:
+            self.skip(name)
+
+    def _begin(self, fieldname):
+        # read the message header if necessary and peek at
+        # the next field prefix, returning the field type, or
+        # None for a field absent from an older message version
+        if self._pos == -1:
+            self._start()
         if self._data is not None:
-            if self._data.bytes_remaining() == 0:
-                self._data = None
-            else:
-                raise Exception('cannot read field, cursor still on data')
+            self._finish_data()
+
+        if self._level == _TRUSTED:
+            if self._peek is None:
+                self._peek = self.stream.read(1)
+            try:
+                return _PREFIX_TYPES[self._peek]
+            except KeyError:
+                raise SendlibError('unknown field prefix "%s"' % self._peek)
 
         if self._peek is None:
+            # nothing is read for a field which may not be read
+            self._field(fieldname)
+            if self._transcoder is not None:
+                skip = self._transcoder.skips[self._pos]
+                if skip is None:
+                    return None
+                for i in xrange(skip):
+                    self._skip_value(self.stream.read(1))
             self._peek = self.stream.read(1)
-        typename = self._check(fieldname)
-        reader = getattr(self, '_read_' + typename)
-        value = reader()
-        self._pos += 1
-        self._peek = None
+        return self._check(fieldname)
+
+    def _start(self):
+        # read the message header
+        self._pos = 0
+        if self._level == _TRUSTED:
+            _discard(self.stream, len(self.message._header()))
+        elif PREFIX['message'] != self.stream.read(1):
+            raise SendlibError('Invalid message format')
+        else:
+            name, version = self._read_header()
+            if (name != self.message.name or
+                    version != self.message.version):
+                self._transcoder = self.message.registry._transcoder(
+                    name, version, self.message)
+
+    def _finish_data(self):
+        # move past the data returned for the last field
+        if self._skip_data:
+            self._data.skip()
+        elif self._data.bytes_remaining() != 0:
+            raise Exception('cannot read field, cursor still on data')
+        self._data = None
+
+    def _read_fixed(self):
+        # read the run of fixed-width fields at the current
+        # position (with the header, if it is not yet read and
+        # need not be checked) with a single unpack, returning
+        # their values, or None if there is no such run
+        if self._random or self._peek is not None:
+            return None
+        if self._pos == -1 and self._level != _TRUSTED:
+            self._start()
+        run = self.message._fixed_run(self._pos)
+        if run is None or self._transcoder is not None:
+            return None
+        if self._data is not None:
+            self._finish_data()
+        buf = self.stream.read(run.struct.size)
+        if len(buf) != run.struct.size:
+            raise SendlibError('truncated message')
+        values = run.unpack(buf)
+        self._pos = run.end
+        if self._pos == len(self.message.fields) and self._then is not None:
+            self._done()
+        return values
+
+    def _skip_value(self, prefix):
+        if prefix in _FIXED_WIDTH:
+            _discard(self.stream, _FIXED_WIDTH[prefix])
+        elif prefix == PREFIX['str'] or prefix == PREFIX['data']:
+            _discard(self.stream, self._read_int())
+        elif prefix == CHUNKED_PREFIX:
+            length = self._read_int()
+            while length:
+                _discard(self.stream, length)
+                length = self._read_int()
+        elif prefix == LIST_PREFIX:
+            for i in xrange(self._read_int()):
+                self._skip_value(self.stream.read(1))
+        elif prefix == PREFIX['message']:
+            message = self.message.registry.get_message(*self._read_header())
+            if message is None:
+                raise SendlibError('unknown nested message')
+            for field in message.fields:
+                self._skip_value(self.stream.read(1))
+        else:
+            raise SendlibError('unknown field prefix "%s"' % prefix)
+
+class _Transcoder(object):
+    # the plan for reading a message of `source` format as one of
+    # `target` format: skips[i] is the number of source fields to
+    # skip before target field i, or None if source has no such
+    # field, in which case it reads as defaults[i]; tail is the
+    # number of source fields after the last one read
+    __slots__ = ('skips', 'defaults', 'tail')
+    def __init__(self, source, target):
+        positions = dict(
+            (field.name, pos) for pos, field in enumerate(source.fields))
+        self.skips = []
+        self.defaults = []
+        last = -1
+        for field in target.fields:
+            pos = positions.get(field.name)
+            if pos is None:
+                if field.default is Nothing and 'nil' not in field.types:
+                    raise SendlibError(
+                        'cannot read %s as %s: field "%s" has no default' %
+                        (source, target, field.name))
+                self.skips.append(None)
+                self.defaults.append(
+                    None if field.default is Nothing else field.default)
+                continue
+            if pos < last:
+                raise SendlibError(
+                    'cannot read %s as %s: field "%s" is out of order' %
+                    (source, target, field.name))
+            self.skips.append(pos - last - 1)
+            self.defaults.append(None)
+            last = pos
+        self.tail = len(source.fields) - last - 1
+
+class _FixedRun(object):
+    # a run of consecutive fields each of a single fixed-width
+    # type, read or written with one struct, which for a run
+    # beginning at position -1 also holds the message header
+    __slots__ = ('fields', 'end', 'header', 'struct', 'prefixes', 'bools')
+    def __init__(self, message, pos):
+        start = end = max(pos, 0)
+        while end < len(message.fields) and \
+              message.fields[end].types[0] in _FIXED_FORMATS and \
+              len(message.fields[end].types) == 1:
+            end += 1
+        self.fields = message.fields[start:end]
+        self.end = end
+        self.header = message._header() if pos == -1 else None
+        types = [field.types[0] for field in self.fields]
+        fmt = ''.join(_FIXED_FORMATS[t] for t in types)
+        if self.header is not None:
+            fmt = '%ds' % len(self.header) + fmt
+        self.struct = struct.Struct('>' + fmt)
+        self.prefixes = tuple(PREFIX[t] for t in types)
+        self.bools = [i for i, t in enumerate(types) if t == 'bool']
+
+    def pack(self, values):
+        # the encoded run, or None if a value is not of its
+        # field's type
+        args = [] if self.header is None else [self.header]
+        for field, prefix in zip(self.fields, self.prefixes):
+            value = _field_value(field, values)
+            if _VALUE_TYPES.get(value.__class__) != field.types[0]:
+                return None
+            if prefix == PREFIX['bool']:
+                value = 't' if value else 'f'
+            args.append(prefix)
+            args.append(value)
+        return self.struct.pack(*args)
+
+    def unpack(self, buf):
+        items = self.struct.unpack(buf)
+        start = 0 if self.header is None else 1
+        prefixes = items[start::2]
+        if prefixes != self.prefixes:
+            for field, prefix in zip(self.fields, prefixes):
+                if prefix not in _PREFIX_TYPES:
+                    raise SendlibError('unknown field prefix "%s"' % prefix)
+                if _PREFIX_TYPES[prefix] != field.types[0]:
+                    raise SendlibError(
+                        'field type "%s" incorrect for field %s' %
+                        (_PREFIX_TYPES[prefix], field))
+        values = list(items[start + 1::2])
+        for i in self.bools:
+            values[i] = values[i] == 't'
+        return values
+
+class Record(object):
+    """
+    :class:`Record` is the base class of the classes returned by
+    :meth:`Message.record_class`. Each field of the message is
+    stored in a slot, named after the field (with characters not
+    valid in Python identifiers replaced by ``_``).
+
+    Records may be constructed with field values given positionally,
+    in schema order, or by attribute name; fields not given are
+    ``None``.
+
+    A field named ``get`` hides the :meth:`get` method of its
+    records; call ``Record.get(record, fieldname)`` instead.
+    """
+
+    __slots__ = ()
+    _message = None
+    _attrs = {}
+    _positions = {}
+    def __init__(self, *args, **kwargs):
+        attrs = self.__slots__
+        if len(args) > len(attrs):
+            raise TypeError('%s takes at most %d fields (%d given)' %
+                            (type(self).__name__, len(attrs), len(args)))
+        for attr, value in zip(attrs, args):
+            setattr(self, attr, value)
+        for attr in attrs[len(args):]:
+            setattr(self, attr, kwargs.pop(attr, None))
+        if kwargs:
+            raise TypeError('%s has no field "%s"' %
+                            (type(self).__name__, kwargs.keys()[0]))
+
+    def get(self, fieldname, default=None):
+        """
+        Return the value of the field named `fieldname` (as it
+        appears in the schema), or `default` if there is none.
+        """
+        attr = self._attrs.get(fieldname)
+        if attr is None:
+            return default
+        return getattr(self, attr)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and \
+               all(getattr(self, a) == getattr(other, a)
+                   for a in self.__slots__)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % (a, getattr(self, a)) for a in self.__slots__))
+
+_unread = object()
+class MessageView(object):
+    """
+    A :class:`MessageView` provides random, repeatable access to
+    the fields of a complete message held in a buffer (a string
+    or :mod:`mmap`). On construction the message is scanned once,
+    using only prefixes and lengths, to find where each field
+    begins; individual fields are decoded only when accessed, and
+    then cached.
+
+    Fields may be accessed as attributes (named as for
+    :meth:`Message.record_class`) or by indexing with the field
+    name. Nested messages are returned as :class:`MessageView`
+    objects, ``many`` fields as lists, and ``data`` fields as a
+    new :class:`Data` object on each access.
+
+    You ordinarily obtain a :class:`MessageView` by calling
+    :meth:`Message.view`.
+
+    Its own attributes are prefixed with ``_``, as fields may
+    have any other name:
+
+    .. py:attribute:: _message
+
+       The :class:`Message` viewed
+
+    .. py:attribute:: _end
+
+       The offset in the buffer just past the end of the message
+    """
+
+    __slots__ = ('_message', '_buf', '_end', '_offsets', '_cache')
+    def __init__(self, message, buf, offset=0):
+        name, version, start = _scan_header(buf, offset)
+        if name != message.name or version != message.version:
+            raise SendlibError(
+                'view of %s cannot read message of type (%s, %d)'
+                % (message, name, version))
+        registry = message.registry
+        offsets = array.array('L', [start])
+        for field in message.fields:
+            start = _scan_value(registry, buf, start)
+            offsets.append(start)
+        if start > len(buf):
+            raise SendlibError('truncated message')
+        self._message = message
+        self._buf = buf
+        self._end = start
+        self._offsets = offsets
+        self._cache = [_unread] * len(message.fields)
+
+    def _decode(self, pos):
+        field = self._message.fields[pos]
+        start, end = self._offsets[pos], self._offsets[pos + 1]
+        prefix = self._buf[start]
+        if prefix == PREFIX['message']:
+            return self._view(field.types, start)
+        if prefix == LIST_PREFIX and _scan_length(self._buf, start) and \
+           self._buf[start + 5] == PREFIX['message']:
+            types = [m.group(1) for m in map(_many.match, field.types) if m]
+            out = []
+            start += 5
+            for i in xrange(_scan_length(self._buf, start - 5)):
+                view = self._view(types, start)
+                out.append(view)
+                start = view._end
+            return out
+        reader = Reader(self._message, _BufferStream(self._buf, start, end))
+        reader._pos = pos
+        return reader.read(field.name)
+
+    def _view(self, types, offset):
+        name, version, _ = _scan_header(self._buf, offset)
+        if 'msg (%s, %d)' % (name, version) not in types:
+            raise SendlibError(
+                'message (%s, %d) not valid here' % (name, version))
+        message = self._message.registry[(name, version)]
+        return MessageView(message, self._buf, offset)
+
+    def _get(self, pos):
+        value = self._cache[pos]
+        if value is _unread:
+            value = self._decode(pos)
+            if not isinstance(value, Data):
+                self._cache[pos] = value
         return value
 
+    def __getitem__(self, fieldname):
+        pos = self._message._position(fieldname)
+        if pos is None:
+            raise KeyError(fieldname)
+        return self._get(pos)
+
+    def __getattr__(self, attr):
+        pos = self._message.record_class()._positions.get(attr)
+        if pos is None:
+            raise AttributeError(attr)
+        return self._get(pos)
+
+    def __repr__(self):
+        return 'MessageView(%s, %s)' % (repr(self._message.name),
+                                        self._message.version)
+
 _or = re.compile(r'\s*or\s*')
 _msg = re.compile(r'msg\s*\(\s*(\w+),\s*(\d+)\s*\)')
 _many = re.compile(r'many\s+(.+?)\s*$')
@@ -497,13 +1805,19 @@ class Field(object):
        :class:`tuple` of type specifiers for this :class:`Field`,
        which may include references to :class:`Message` instances,
        if this :class:`Field` is a nested message field.
+
+    .. py:attribute:: default
+
+       The value read for this field from messages of other
+       versions which lack it, or :class:`Nothing`
     """
 
-    __slots__ = ('message', 'name', 'types', 'spec')
-    def __init__(self, message, name, types):
+    __slots__ = ('message', 'name', 'types', 'spec', 'default', '_size')
+    def __init__(self, message, name, types, default=Nothing):
         self.message = message
         self.name = name
         self.spec = types
+        self.default = default
         self.types = []
         for type in _or.split(types):
             do_many = False
@@ -533,9 +1847,120 @@ class Field(object):
                 self.types.append(type)
         self.types = tuple(self.types)
 
+        # the encoded size of every value of this field, if
+        # that does not depend on the value, else None
+        sizes = set(_FIELD_WIDTH.get(t) for t in self.types)
+        self._size = sizes.pop() if len(sizes) == 1 else None
+
+        if default is not Nothing and \
+           _VALUE_TYPES[default.__class__] not in self.types:
+            raise ParseError(
+                'default %s does not match field spec "%s"' %
+                (repr(default), self.spec))
+
     def __repr__(self):
         return 'Field(%s, %s)' % (repr(self.name), self.types)
 
+    def _message_types(self, many=False):
+        # the Messages which may be nested in this field,
+        # either directly or (if `many`) as list elements
+        out = []
+        for type_name in self.types:
+            if many:
+                m = _many.match(type_name)
+                if not m:
+                    continue
+                type_name = m.group(1)
+            m = _msg.match(type_name)
+            if m:
+                key = (m.group(1), int(m.group(2)))
+                out.append(self.message.registry[key])
+        return out
+
+class EncodeCache(object):
+    """
+    :class:`EncodeCache` holds the encoded form of messages, so
+    that writing the same values again (as with a sub-message
+    repeated in every message sent, or an unchanging heartbeat)
+    copies their encoding rather than encoding them anew. Pass
+    it to :meth:`Message.encode` or :meth:`Writer.write_all`.
+
+    Values are cached by identity: the dictionary or record
+    written is the key, so it must not be changed once written
+    with a cache (and any ``data`` in it is read only once). If
+    `messages` is given, only messages of those formats, whether
+    written directly or nested, are cached; otherwise all are.
+    The least recently used encodings are dropped to keep the
+    total size of those cached at most `max_size` bytes.
+
+    The ``hits``, ``misses`` and ``evictions`` attributes count
+    the lookups of cached messages which were and were not found,
+    and the encodings dropped to make room; ``size`` is the
+    number of bytes cached.
+    """
+
+    __slots__ = ('max_size', 'messages', 'hits', 'misses', 'evictions',
+                 'size', '_entries', '_lock')
+    def __init__(self, max_size=1024 * 1024, messages=None):
+        self.max_size = max_size
+        self.messages = None if messages is None else frozenset(messages)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.size = 0
+        # maps (message, id(value)) to (value, encoded), oldest
+        # first; holding the value keeps its id from being reused
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def hit_rate(self):
+        """
+        Return the fraction of lookups which were found in the
+        cache, or 0.0 if there have been none.
+        """
+        lookups = self.hits + self.misses
+        return float(self.hits) / lookups if lookups else 0.0
+
+    def clear(self):
+        """
+        Drop every cached encoding (the counts are kept).
+        """
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
+
+    def _caches(self, message):
+        return self.messages is None or message in self.messages
+
+    def _get(self, message, value):
+        key = (message, id(value))
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[1]
+
+    def _put(self, message, value, encoded):
+        if len(encoded) > self.max_size:
+            return
+        key = (message, id(value))
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[1])
+            self._entries[key] = (value, encoded)
+            self.size += len(encoded)
+            while self.size > self.max_size:
+                value, old = self._entries.popitem(last=False)[1]
+                self.size -= len(old)
+                self.evictions += 1
+
 class Message(object):
     """
     :class:`Message` contains the definition of a single
@@ -560,12 +1985,58 @@ class Message(object):
        :class:`tuple` of :class:`Field`
     """
 
-    __slots__ = ('registry', 'name', 'version', 'fields')
+    __slots__ = ('registry', 'name', 'version', 'fields', '_record_class',
+                 '_positions', '_encoded_header', '_nil_runs', '_fixed_runs',
+                 '_readers', '_writers')
     def __init__(self, registry, name, version, fields):
         self.registry = registry
         self.name = name
         self.version = version
         self.fields = fields
+        self._record_class = None
+        self._positions = None
+        self._encoded_header = None
+        self._nil_runs = None
+        self._fixed_runs = None
+        self._readers = []
+        self._writers = []
+
+    def _position(self, fieldname):
+        # the index of the field named `fieldname`, or None
+        if self._positions is None:
+            self._positions = dict(
+                (field.name, pos) for pos, field in enumerate(self.fields))
+        return self._positions.get(fieldname)
+
+    def _nil_run(self, pos):
+        # the position of the first field at or after `pos` which
+        # does not allow nil; a writer at `pos` may skip to any
+        # field up to and including that one by writing nils
+        if self._nil_runs is None:
+            runs = []
+            end = len(self.fields)
+            for i in xrange(len(self.fields) - 1, -1, -1):
+                if 'nil' not in self.fields[i].types:
+                    end = i
+                runs.append(end)
+            self._nil_runs = tuple(reversed(runs))
+        return self._nil_runs[pos]
+
+    def _fixed_run(self, pos):
+        # the _FixedRun beginning at `pos` (or, at -1, at the first
+        # field, with the header), or None if the field at `pos`
+        # is not of a single fixed-width type
+        if self._fixed_runs is None:
+            runs = [None]
+            for field in self.fields:
+                if len(field.types) == 1 and field.types[0] in _FIXED_FORMATS:
+                    runs.append(_FixedRun(self, len(runs) - 1))
+                else:
+                    runs.append(None)
+            if len(runs) > 1 and runs[1] is not None:
+                runs[0] = _FixedRun(self, -1)
+            self._fixed_runs = tuple(runs)
+        return self._fixed_runs[pos + 1]
 
     def __repr__(self):
         return 'Message(%s, %s, %s)' % (repr(self.name),
@@ -578,21 +2049,157 @@ class Message(object):
                self.name == other.name and \
                self.version == other.version
 
-    def reader(self, in_stream):
+    def reader(self, in_stream, random_access=False, skip_data=False,
+               validate='full'):
         """
         Return a :class:`Reader` object which reads
         messages of this format from `in_stream`. `in_stream`
-        must have a ``read(size)`` method.
+        must have a ``read(size)`` method, and, if `random_access`
+        is true, ``seek`` and ``tell`` methods. See :class:`Reader`
+        for `skip_data` and `validate`. A reader given to
+        :meth:`release` may be returned again.
         """
-        return Reader(self, in_stream)
-
-    def writer(self, out_stream):
+        try:
+            reader = self._readers.pop()
+        except IndexError:
+            return Reader(self, in_stream, random_access, skip_data, validate)
+        reader.reset(in_stream)
+        reader._random = random_access
+        reader._skip_data = skip_data
+        reader._level = _level(validate)
+        return reader
+
+    def writer(self, out_stream, validate='full'):
         """
         Return a :class:`Writer` object which writes
         messages of this format to `out_stream`. `out_stream`
-        must have a ``write(str)`` method.
+        must have a ``write(str)`` method. See :class:`Writer`
+        for `validate`. A writer given to :meth:`release` may be
+        returned again.
+        """
+        try:
+            writer = self._writers.pop()
+        except IndexError:
+            return Writer(self, out_stream, validate)
+        writer.reset(out_stream)
+        writer._level = _level(validate)
+        return writer
+
+    def release(self, obj):
+        """
+        Return `obj`, a :class:`Reader` or :class:`Writer` for
+        this message which is no longer needed, to be reused by
+        later calls to :meth:`reader` or :meth:`writer`, sparing
+        an allocation in loops which read or write many messages.
+        `obj` must not be used after it is released.
+        """
+        if obj.message is not self:
+            raise SendlibError('%r is not for message %s' % (obj, self))
+        pool = self._writers if isinstance(obj, Writer) else self._readers
+        if len(pool) < _POOL_SIZE:
+            obj.stream = None
+            pool.append(obj)
+
+    def _header(self):
+        # the encoded message prefix, name and version
+        if self._encoded_header is None:
+            name = codecs.encode(self.name, 'utf-8')
+            self._encoded_header = ''.join((
+                PREFIX['message'],
+                _SIZED_HEADER.pack(PREFIX['str'], len(name)), name,
+                _SIZED_HEADER.pack(PREFIX['int'], self.version)))
+        return self._encoded_header
+
+    def record_class(self):
+        """
+        Return a subclass of :class:`Record` with a slot for each
+        field of this message. The same class is returned on every
+        call.
+        """
+        if self._record_class is None:
+            attrs = {}
+            for field in self.fields:
+                attr = re.sub(r'\W|^(?=\d)', '_', field.name)
+                if attr in attrs.values():
+                    raise SendlibError(
+                        'field "%s" of %s has the same attribute name as '
+                        'another field' % (field.name, self))
+                attrs[field.name] = str(attr)
+            self._record_class = type(
+                str(re.sub(r'\W', '_', '%s_%d' % (self.name, self.version))),
+                (Record, ),
+                {'__slots__': tuple(attrs[f.name] for f in self.fields),
+                 '_message': self,
+                 '_attrs': attrs,
+                 '_positions': dict((attrs[f.name], pos) for pos, f
+                                    in enumerate(self.fields))})
+        return self._record_class
+
+    def view(self, buf, offset=0):
+        """
+        Return a :class:`MessageView` of the message of this format
+        which begins at `offset` in `buf`.
         """
-        return Writer(self, out_stream)
+        return MessageView(self, buf, offset)
+
+    def encoded_size(self, values):
+        """
+        Return the number of bytes that :meth:`encode` would write
+        for `values`, without encoding them. File-like objects given
+        for ``data`` fields are measured by seeking to their end, as
+        when they are written; wrap them in a :class:`DataSource` to
+        measure them only once.
+        """
+        return _encoded_size(self, values)
+
+    def encode(self, out_stream, values, validate='full', cache=None):
+        """
+        Write a complete message of this format to `out_stream`.
+        `values` is either a dictionary mapping field names to
+        values or an instance of :meth:`record_class`; absent or
+        ``None`` fields are written as ``nil``, or as their defaults
+        if they do not allow ``nil``. Nested messages are
+        given as dictionaries or records (or lists of them, for
+        ``many`` fields); dictionaries may only be used for fields
+        which allow a single message type. `validate` is as for
+        :class:`Writer`, and `cache` as for :meth:`Writer.write_all`.
+        """
+        writer = self.writer(out_stream, validate)
+        writer.write_all(values, cache)
+        self.release(writer)
+
+    def relay(self, in_stream, out_stream, rewrite=None):
+        """
+        Copy a message of this format from `in_stream` to
+        `out_stream` without decoding it, as for
+        :meth:`MessageRegistry.relay`, and return this message.
+        Raises :class:`SendlibError` if the message in `in_stream`
+        has another format.
+        """
+        message = _relay(self.registry, in_stream, out_stream, rewrite,
+                         expected=self)
+        if message is None:
+            raise SendlibError('unexpected end of stream')
+        return message
+
+    def decode(self, in_stream, fields=None, record=False, validate='full'):
+        """
+        Read a complete message of this format from `in_stream`
+        and return a dictionary of its field values, as for
+        :func:`decode_file`, or, if `record` is true, an instance
+        of :meth:`record_class` (with nested messages likewise
+        decoded into records).
+
+        If `fields` is given, only the named fields are decoded;
+        the others are skipped as with :meth:`Reader.skip`, and
+        omitted from the dictionary, or ``None`` in the record. In
+        either case, `in_stream` is left positioned after the end
+        of the message. `validate` is as for :class:`Reader`.
+        """
+        if fields is not None:
+            fields = frozenset(fields)
+        return _read_values(self.reader(in_stream, validate=validate),
+                            fields, record)
 
 
 class MessageRegistry(object):
@@ -602,9 +2209,10 @@ class MessageRegistry(object):
     sending messages.
     """
 
-    __slots__ = ('messages', )
+    __slots__ = ('messages', '_transcoders')
     def __init__(self, messages):
         self.messages = messages
+        self._transcoders = {}
 
     def __getitem__(self, key):
         """
@@ -625,6 +2233,54 @@ class MessageRegistry(object):
         except KeyError:
             return None
 
+    def _transcoder(self, name, version, target):
+        # the _Transcoder for reading (name, version) as `target`,
+        # built on first use
+        key = (name, version, target.name, target.version)
+        transcoder = self._transcoders.get(key)
+        if transcoder is None:
+            source = self.get_message(name, version)
+            if name != target.name or source is None:
+                raise SendlibError(
+                    'Reader for %s cannot read message of type (%s, %d)'
+                    % (target, name, version))
+            transcoder = self._transcoders[key] = \
+                _Transcoder(source, target)
+        return transcoder
+
+    def relay(self, in_stream, out_stream, rewrite=None):
+        """
+        Copy the next message, of any format in this registry,
+        from `in_stream` to `out_stream`, and return its
+        :class:`Message`, or ``None`` if `in_stream` is at its end.
+
+        Only the prefixes and lengths in the stream are read, to
+        find the extent of each field and nested message; values
+        are copied as they are, in large writes.
+
+        If `rewrite` is given, it is called with the
+        :class:`Message` read, and returns the :class:`Message`
+        whose name and version are written in its place (which
+        must have fields of the same types, or :class:`SendlibError`
+        is raised), or ``None`` to read the message without
+        writing it.
+        """
+        return _relay(self, in_stream, out_stream, rewrite)
+
+_DEFAULT_NAMES = {'nil': None, 'true': True, 'false': False}
+def _parse_default(text, lineno):
+    if text in _DEFAULT_NAMES:
+        return _DEFAULT_NAMES[text]
+    try:
+        value = ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        value = None
+    if type(value) is str:
+        return unicode(value, 'utf-8')
+    if type(value) not in (int, long, float):
+        raise ParseError('invalid default "%s" at line %d' % (text, lineno))
+    return value
+
 def parse(schema):
     """
     Parse `schema`, either a string or a file-like object, and
@@ -635,7 +2291,7 @@ def parse(schema):
         schema = schema.read()
 
     message = re.compile(r'^\(([^,]+),\s*(\d+)\):\s*$')
-    field = re.compile(r'^-\s*([^:]+):\s+(.+?)\s*$')
+    field = re.compile(r'^-\s*([^:]+):\s+([^=]+?)\s*(?:=\s*(.+?)\s*)?$')
 
     registry = MessageRegistry({})
     messages = registry.messages
@@ -655,8 +2311,11 @@ def parse(schema):
                     'field definition outside of message at line %d' % lineno)
             name = f.group(1)
             type = f.group(2)
+            default = Nothing
+            if f.group(3) is not None:
+                default = _parse_default(f.group(3), lineno)
             if name not in names:
-                f = Field(curr, name, type)
+                f = Field(curr, name, type, default)
                 curr.fields.append(f)
                 names.add(name)
                 continue
@@ -680,3 +2339,1431 @@ def parse(schema):
     return registry
 
 
+
+def _get(values, fieldname):
+    # a field named "get" hides the method of records
+    if isinstance(values, Record):
+        return Record.get(values, fieldname)
+    return values.get(fieldname)
+
+def _field_value(field, values):
+    value = _get(values, field.name)
+    if value is None and field.default is not Nothing and \
+       'nil' not in field.types:
+        return field.default
+    return value
+
+# encoded sizes of fixed-width values, by field type and by
+# the python type of the value
+_FIELD_WIDTH = {'int': 5, 'float': 9, 'bool': 2, 'nil': 1}
+_VALUE_WIDTH = {int: 5, long: 5, float: 9, bool: 2, type(None): 1}
+def _encoded_size(message, values):
+    size = len(message._header())
+    for field in message.fields:
+        if field._size is not None:
+            size += field._size
+            continue
+        value = _field_value(field, values)
+        if isinstance(value, (dict, Record)):
+            size += _encoded_size(_nested_message(field, value), value)
+        elif type(value) in (list, tuple):
+            size += 5
+            for item in value:
+                if isinstance(item, (dict, Record)):
+                    size += _encoded_size(
+                        _nested_message(field, item, many=True), item)
+                else:
+                    size += _value_size(item)
+        else:
+            size += _value_size(value)
+    return size
+
+def _value_size(value):
+    width = _VALUE_WIDTH.get(type(value))
+    if width is not None:
+        return width
+    if type(value) is unicode:
+        return 5 + len(codecs.encode(value, 'utf-8'))
+    if type(value) is str:
+        return 5 + len(value)
+    if not isinstance(value, DataSource):
+        value = DataSource(value)
+    if value.length is None or value.length > _MAX_LENGTH:
+        raise SendlibError(
+            'the size of chunked data cannot be computed in advance')
+    return 5 + value.length
+
+def _nested_message(field, value, many=False):
+    # records know their message; dicts may only be
+    # written to fields with exactly one message type
+    if isinstance(value, Record):
+        return value._message
+    submsg = field._message_types(many)
+    if len(submsg) > 1:
+        raise SendlibError(
+            'more than one message valid for field %s, use a record' %
+            field.name)
+    return submsg[0] if submsg else value
+
+_skipped = object()
+def _read_values(reader, fields=None, record=False):
+    # read every field of reader's message (or only those named
+    # in `fields`) into a dict, or a Record if `record`; data
+    # fields are read fully into memory. nested messages are
+    # read from an explicit stack, not by recursion: each entry
+    # is a reader (or, for a ``many msg`` field, the generator of
+    # its readers), the fields to read, and the values so far
+    stack = [(reader, fields, [])]
+    while True:
+        reader, fields, values = stack[-1]
+        if isinstance(reader, types.GeneratorType):
+            for nested in reader:
+                stack.append((nested, None, []))
+                break
+            else:
+                stack.pop()
+                stack[-1][2].append(values)
+            continue
+
+        message = reader.message
+        while len(values) < len(message.fields):
+            run = reader._read_fixed()
+            if run is not None:
+                if fields is not None:
+                    run = [v if field.name in fields else _skipped
+                           for field, v
+                           in zip(message.fields[len(values):], run)]
+                values.extend(run)
+                continue
+            field = message.fields[len(values)]
+            if fields is not None and field.name not in fields:
+                reader.skip(field.name)
+                values.append(_skipped)
+                continue
+            value = reader.read(field.name)
+            if isinstance(value, (Reader, types.GeneratorType)):
+                stack.append((value, None, []))
+                break
+            elif isinstance(value, Data):
+                value = value.read()
+            values.append(value)
+        else:
+            if reader._pos == -1:
+                # a message without fields is only its header
+                reader._start()
+            message.release(reader)
+            if record:
+                value = message.record_class()(
+                    *[None if v is _skipped else v for v in values])
+            else:
+                value = dict(
+                    (field.name, v) for field, v in zip(message.fields, values)
+                    if v is not _skipped)
+            stack.pop()
+            if not stack:
+                return value
+            stack[-1][2].append(value)
+
+_FIXED_WIDTH = {'I': 4, 'F': 8, 'B': 1, 'N': 0}
+def _scan_header(buf, offset):
+    # return the name and version of the message which begins
+    # at `offset` in `buf`, and the offset of its first field
+    try:
+        if buf[offset] != PREFIX['message'] or \
+           buf[offset + 1] != PREFIX['str']:
+            raise SendlibError('Invalid message format')
+        length = struct.unpack_from('>L', buf, offset + 2)[0]
+        name = buf[offset + 6:offset + 6 + length]
+        offset += 6 + length
+        if buf[offset] != PREFIX['int']:
+            raise SendlibError('Invalid message format')
+        version = struct.unpack_from('>L', buf, offset + 1)[0]
+    except (IndexError, struct.error):
+        raise _Truncated('truncated message')
+    return unicode(name, 'utf-8'), version, offset + 5
+
+def _scan(registry, buf, offset):
+    """
+    Return the offset just past the message which begins at
+    `offset` in `buf`, using only prefixes and length fields
+    (no values are decoded).
+    """
+    name, version, offset = _scan_header(buf, offset)
+    message = registry.get_message(name, version)
+    if message is None:
+        raise SendlibError('unknown message (%s, %d)' % (name, version))
+    for field in message.fields:
+        offset = _scan_value(registry, buf, offset)
+    if offset > len(buf):
+        raise _Truncated('truncated message')
+    return offset
+
+def _scan_value(registry, buf, offset):
+    # return the offset just past the field value
+    # which begins at `offset` in `buf`
+    prefix = buf[offset:offset + 1]
+    if prefix in _FIXED_WIDTH:
+        return offset + 1 + _FIXED_WIDTH[prefix]
+    elif prefix == PREFIX['str'] or prefix == PREFIX['data']:
+        return offset + 5 + _scan_length(buf, offset)
+    elif prefix == CHUNKED_PREFIX:
+        length = _scan_length(buf, offset)
+        offset += 5
+        while length:
+            offset += length
+            length = _scan_length(buf, offset - 1)
+            offset += 4
+        return offset
+    elif prefix == LIST_PREFIX:
+        length = _scan_length(buf, offset)
+        offset += 5
+        for i in xrange(length):
+            offset = _scan_value(registry, buf, offset)
+        return offset
+    elif prefix == PREFIX['message']:
+        return _scan(registry, buf, offset)
+    elif prefix == '':
+        raise _Truncated('truncated message')
+    raise SendlibError('unknown field prefix "%s"' % prefix)
+
+def _scan_length(buf, offset):
+    # the length or count following the prefix at `offset`
+    try:
+        return struct.unpack_from('>L', buf, offset + 1)[0]
+    except struct.error:
+        raise _Truncated('truncated message')
+
+class _Relay(object):
+    # copies a message from `stream` by `write`, using only its
+    # prefixes and lengths; small pieces are collected and written
+    # together, and longer strings and data copied through in blocks
+    __slots__ = ('registry', 'stream', 'write', '_pending', '_size')
+    def __init__(self, registry, stream, write):
+        self.registry = registry
+        self.stream = stream
+        self.write = write
+        self._pending = []
+        self._size = 0
+
+    def _take(self, size):
+        data = _read_exactly(self.stream, size)
+        if len(data) < size:
+            raise SendlibError('unexpected end of stream')
+        self._pending.append(data)
+        self._size += size
+        if self._size >= _BLOCK_SIZE:
+            self._send()
+        return data
+
+    def _send(self):
+        if self._pending:
+            self.write(''.join(self._pending))
+            self._pending = []
+            self._size = 0
+
+    def _copy(self, size):
+        if size < _COPY_LIMIT:
+            self._take(size)
+            return
+        self._send()
+        while size:
+            data = self.stream.read(min(size, _BLOCK_SIZE))
+            if not data:
+                raise SendlibError('unexpected end of stream')
+            self.write(data)
+            size -= len(data)
+
+    def _length(self):
+        return _LENGTH.unpack(self._take(4))[0]
+
+    def _header(self):
+        # the message whose name and version follow
+        # an already-copied message prefix
+        if self._take(1) != PREFIX['str']:
+            raise SendlibError('Invalid message format')
+        name = unicode(self._take(self._length()), 'utf-8')
+        if self._take(1) != PREFIX['int']:
+            raise SendlibError('Invalid message format')
+        version = self._length()
+        message = self.registry.get_message(name, version)
+        if message is None:
+            raise SendlibError('unknown message (%s, %d)' % (name, version))
+        return message
+
+    def _fields(self, message):
+        for field in message.fields:
+            self._value(self._take(1))
+
+    def _value(self, prefix):
+        if prefix in _FIXED_WIDTH:
+            self._take(_FIXED_WIDTH[prefix])
+        elif prefix == PREFIX['str'] or prefix == PREFIX['data']:
+            self._copy(self._length())
+        elif prefix == CHUNKED_PREFIX:
+            length = self._length()
+            while length:
+                self._copy(length)
+                length = self._length()
+        elif prefix == LIST_PREFIX:
+            for i in xrange(self._length()):
+                self._value(self._take(1))
+        elif prefix == PREFIX['message']:
+            self._fields(self._header())
+        else:
+            raise SendlibError('unknown field prefix "%s"' % prefix)
+
+def _relay(registry, in_stream, out_stream, rewrite=None, expected=None):
+    prefix = in_stream.read(1)
+    if not prefix:
+        return None
+    if prefix != PREFIX['message']:
+        raise SendlibError('Invalid message format')
+    relay = _Relay(registry, in_stream, out_stream.write)
+    relay._pending.append(prefix)
+    message = relay._header()
+    if expected is not None and message != expected:
+        raise SendlibError('cannot relay message of type (%s, %d) as %s' %
+                           (message.name, message.version, expected))
+    if rewrite is not None:
+        target = rewrite(message)
+        if target is None:
+            relay.write = lambda data: None
+            relay._pending = []
+        elif target is not message:
+            if [f.types for f in target.fields] != \
+               [f.types for f in message.fields]:
+                raise SendlibError(
+                    'cannot relay message of type (%s, %d) as %s, '
+                    'whose fields differ' %
+                    (message.name, message.version, target))
+            relay._pending = [target._header()]
+        relay._size = sum(map(len, relay._pending))
+    relay._fields(message)
+    relay._send()
+    return message
+
+# per-process state for encode_file and decode_file workers
+_worker_registry = None
+
+def _init_worker(registry):
+    global _worker_registry
+    _worker_registry = registry
+
+def _encode_batch(args):
+    key, records = args
+    message = _worker_registry[key]
+    buf = StringIO()
+    for record in records:
+        message.encode(buf, record)
+    return buf.getvalue()
+
+def _decode_batch(args):
+    key, chunk = args
+    message = _worker_registry[key]
+    buf = StringIO(chunk)
+    out = []
+    while buf.tell() < len(chunk):
+        out.append(_read_values(message.reader(buf)))
+    return out
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def _map(registry, func, tasks, workers):
+    if workers == 1:
+        _init_worker(registry)
+        return itertools.imap(func, tasks)
+    pool = multiprocessing.Pool(workers, _init_worker, (registry, ))
+    def results():
+        try:
+            for result in pool.imap(func, tasks):
+                yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    return results()
+
+def encode_file(message, records, out_stream, workers=None, batch_size=1000):
+    """
+    Write one instance of `message` to `out_stream` for each
+    dictionary in `records`, sharing the encoding work among
+    `workers` processes (by default, one per CPU). The output
+    is identical to writing each record in order with a
+    :class:`Writer`.
+
+    Each record maps field names to values; absent fields are
+    written as ``nil``, and nested messages are given as
+    dictionaries (or lists of dictionaries for ``many`` fields).
+    Records are sent to worker processes in batches of
+    `batch_size`, so their values must be picklable.
+    """
+    key = (message.name, message.version)
+    tasks = ((key, batch) for batch in _batches(records, batch_size))
+    for chunk in _map(message.registry, _encode_batch, tasks, workers):
+        out_stream.write(chunk)
+
+def decode_file(message, in_stream, workers=None, batch_bytes=1024 * 1024):
+    """
+    Read consecutive instances of `message` from the current
+    position of `in_stream` until it is exhausted, decoding
+    them in `workers` processes (by default, one per CPU), and
+    yield a dictionary of field values for each, in stream
+    order. ``data`` fields are
+    returned as strings, nested messages as dictionaries.
+
+    `in_stream` is split at message boundaries by scanning
+    prefixes and lengths only; workers receive chunks of about
+    `batch_bytes` bytes. If `in_stream` has a ``fileno``, it is
+    memory-mapped rather than read into memory.
+    """
+    try:
+        buf = mmap.mmap(in_stream.fileno(), 0, access=mmap.ACCESS_READ)
+        start = in_stream.tell()
+    except (AttributeError, EnvironmentError, ValueError):
+        buf = in_stream.read()
+        start = 0
+
+    def tasks(start):
+        key = (message.name, message.version)
+        offset = start
+        while offset < len(buf):
+            offset = _scan(message.registry, buf, offset)
+            if offset - start >= batch_bytes:
+                yield key, buf[start:offset]
+                start = offset
+        if start < offset:
+            yield key, buf[start:offset]
+
+    for batch in _map(message.registry, _decode_batch, tasks(start), workers):
+        for values in batch:
+            yield values
+
+_INDEX_MAGIC = 'SLIX\x01'
+_INDEX_TYPE = struct.Struct('>cHLH')
+_INDEX_ENTRY = struct.Struct('>cQLH')
+_FIELD_INDEX_MAGIC = 'SLFX\x01'
+_FIELD_INDEX_HEADER = struct.Struct('>LL')
+_FIELD_INDEX_ENTRY = struct.Struct('>LLL')
+def _index_key(value):
+    # encode an indexed field value such that byte-wise
+    # ordering groups equal values together
+    if type(value) in (int, long):
+        return PREFIX['int'] + struct.pack('>L', value)
+    elif type(value) in (str, unicode):
+        return PREFIX['str'] + codecs.encode(value, 'utf-8')
+    raise SendlibError('cannot index value %s' % repr(value))
+
+class _FieldIndex(object):
+    # a sorted on-disk index of (value, ordinal) pairs for one
+    # field of one message in a MessageLog; the file holds a
+    # header, a table of fixed-size entries sorted by key, and
+    # a heap of the keys themselves
+    __slots__ = ('path', 'message', 'field', 'covered', '_map', '_count',
+                 '_pending')
+    def __init__(self, path, message, field):
+        self.path = path
+        self.message = message
+        self.field = field
+        self._open()
+
+    def _open(self):
+        self.covered = 0
+        self._map = None
+        self._count = 0
+        self._pending = {}
+        try:
+            with open(self.path, 'rb') as fp:
+                if os.fstat(fp.fileno()).st_size:
+                    self._map = mmap.mmap(
+                        fp.fileno(), 0, access=mmap.ACCESS_READ)
+        except IOError:
+            return
+        if self._map is None:
+            return
+        if self._map[:len(_FIELD_INDEX_MAGIC)] != _FIELD_INDEX_MAGIC:
+            raise SendlibError('%s is not a field index' % self.path)
+        self.covered, self._count = _FIELD_INDEX_HEADER.unpack_from(
+            self._map, len(_FIELD_INDEX_MAGIC))
+
+    def add(self, key, ordinal):
+        self._pending.setdefault(key, []).append(ordinal)
+
+    def _entry(self, i):
+        table = len(_FIELD_INDEX_MAGIC) + _FIELD_INDEX_HEADER.size
+        heap = table + self._count * _FIELD_INDEX_ENTRY.size
+        offset, length, ordinal = _FIELD_INDEX_ENTRY.unpack_from(
+            self._map, table + i * _FIELD_INDEX_ENTRY.size)
+        return self._map[heap + offset:heap + offset + length], ordinal
+
+    def find(self, key):
+        out = []
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        while lo < self._count:
+            found, ordinal = self._entry(lo)
+            if found != key:
+                break
+            out.append(ordinal)
+            lo += 1
+        out.extend(self._pending.get(key, ()))
+        return out
+
+    def save(self, covered):
+        if not self._pending and covered == self.covered:
+            return
+        entries = [self._entry(i) for i in xrange(self._count)]
+        for key, ordinals in self._pending.iteritems():
+            entries.extend((key, ordinal) for ordinal in ordinals)
+        entries.sort()
+
+        tmp = self.path + '.tmp'
+        with open(tmp, 'wb') as fp:
+            fp.write(_FIELD_INDEX_MAGIC)
+            fp.write(_FIELD_INDEX_HEADER.pack(covered, len(entries)))
+            offset = 0
+            for key, ordinal in entries:
+                fp.write(_FIELD_INDEX_ENTRY.pack(offset, len(key), ordinal))
+                offset += len(key)
+            for key, ordinal in entries:
+                fp.write(key)
+        os.rename(tmp, self.path)
+        self._open()
+
+class MessageLog(object):
+    """
+    :class:`MessageLog` is an append-only file of messages with a
+    sidecar index (stored at `path` + ``".idx"``) recording the
+    offset, length, name and version of each message, allowing
+    random access by ordinal and filtering by message type
+    without decoding the messages themselves. The log file itself
+    is simply the messages written back to back, and so may also
+    be read sequentially with :class:`Reader`.
+
+    You ordinarily obtain a :class:`MessageLog` by calling
+    :meth:`MessageLog.open`. If the index is missing or lags
+    behind the log (for instance after a crash), the remainder of
+    the log is scanned to rebuild it; in ``'a'`` mode, a partially
+    written trailing message is truncated.
+
+    `indexes` is a sequence of ``(message, field_name)`` pairs
+    naming ``int`` or ``str`` fields (optionally ``or nil``) to
+    index by value, for use with :meth:`find`. Each is stored in
+    its own sorted file alongside the log, which is updated when
+    the log is flushed.
+    """
+
+    __slots__ = ('path', 'registry', 'mode', '_data', '_index', '_map',
+                 '_offsets', '_lengths', '_types', '_type_ids', '_keys',
+                 '_field_indexes')
+    def __init__(self, path, registry, mode='r', indexes=()):
+        if mode not in ('r', 'a'):
+            raise ValueError('mode must be "r" or "a"')
+        for message, field_name in indexes:
+            for field in message.fields:
+                if field.name == field_name:
+                    break
+            else:
+                raise SendlibError(
+                    'message (%s, %d) has no field "%s"' %
+                    (message.name, message.version, field_name))
+            if not set(field.types) <= set(('int', 'str', 'nil')):
+                raise SendlibError(
+                    'cannot index field %s, only int and str fields may be '
+                    'indexed' % field)
+        self.path = path
+        self.registry = registry
+        self.mode = mode
+        self._map = None
+        self._offsets = array.array('L')
+        self._lengths = array.array('L')
+        self._types = array.array('H')
+        self._type_ids = {}
+        self._keys = []
+
+        if mode == 'a':
+            for name in (path, path + '.idx'):
+                if not os.path.exists(name):
+                    open(name, 'wb').close()
+            self._data = open(path, 'r+b')
+            self._index = open(path + '.idx', 'r+b')
+        else:
+            self._data = open(path, 'rb')
+            try:
+                self._index = open(path + '.idx', 'rb')
+            except IOError:
+                self._index = None
+        self._load()
+
+        self._field_indexes = {}
+        for message, field_name in indexes:
+            # names may hold any character but ':', such as '/', so
+            # are escaped to keep the index file beside the log
+            index = _FieldIndex(
+                '%s.%s-%d.%s.idx' % (path, re.sub(r'\W', '_', message.name),
+                                     message.version,
+                                     re.sub(r'\W', '_', field_name)),
+                message, field_name)
+            self._field_indexes[
+                (message.name, message.version, field_name)] = index
+            # catch up on messages logged since the index was saved,
+            # decoding only the indexed field
+            fields = frozenset([field_name])
+            for ordinal in self.select(message):
+                if ordinal >= index.covered:
+                    self._index_values(index, ordinal, _read_values(
+                        self.reader(ordinal), fields))
+
+    @classmethod
+    def open(cls, path, registry, mode='r', indexes=()):
+        """
+        Open the log at `path` for reading (`mode` ``'r'``) or
+        for reading and appending (`mode` ``'a'``), creating it
+        if necessary. Messages are interpreted using `registry`,
+        and fields named in `indexes` are indexed by value.
+        """
+        return cls(path, registry, mode, indexes)
+
+    def _index_values(self, index, ordinal, values):
+        value = _get(values, index.field)
+        if value is not None:
+            index.add(_index_key(value), ordinal)
+
+    def _load(self):
+        # read the index, then scan any part of the
+        # log which it does not yet cover
+        index = self._index.read() if self._index else ''
+        pos = 0
+        if index[:len(_INDEX_MAGIC)] == _INDEX_MAGIC:
+            pos = len(_INDEX_MAGIC)
+        elif index:
+            raise SendlibError('%s.idx is not a message log index' % self.path)
+        while pos < len(index):
+            if index[pos] == 'T':
+                if pos + _INDEX_TYPE.size > len(index):
+                    break
+                _, type_id, version, length = \
+                    _INDEX_TYPE.unpack_from(index, pos)
+                start = pos + _INDEX_TYPE.size
+                if start + length > len(index):
+                    break
+                name = unicode(index[start:start + length], 'utf-8')
+                self._type_ids[(name, version)] = type_id
+                self._keys.append((name, version))
+                pos = start + length
+            elif index[pos] == 'E':
+                if pos + _INDEX_ENTRY.size > len(index):
+                    break
+                _, offset, length, type_id = \
+                    _INDEX_ENTRY.unpack_from(index, pos)
+                self._offsets.append(offset)
+                self._lengths.append(length)
+                self._types.append(type_id)
+                pos += _INDEX_ENTRY.size
+            else:
+                raise SendlibError('corrupt index at offset %d' % pos)
+
+        # discard index entries for messages which did not
+        # make it to disk, and any partially written record
+        size = os.fstat(self._data.fileno()).st_size
+        while self._offsets and self._end() > size:
+            self._offsets.pop()
+            self._lengths.pop()
+            self._types.pop()
+            pos = 0
+        if self.mode == 'a':
+            self._index.seek(pos, 0)
+            self._index.truncate()
+            if pos == 0:
+                self._write_index()
+
+        buf = self._buffer()
+        offset = self._end()
+        if buf is None or offset >= len(buf):
+            return
+        while offset < len(buf):
+            try:
+                end = _scan(self.registry, buf, offset)
+            except _Truncated:
+                # only a partly written last message is dropped;
+                # other errors leave the log as it is
+                break
+            name, version, _ = _scan_header(buf, offset)
+            self._add(offset, end - offset, self.registry[(name, version)])
+            offset = end
+        if self.mode == 'a' and offset < len(buf):
+            self._map = None
+            self._data.seek(offset, 0)
+            self._data.truncate()
+        self._flush_index()
+
+    def _write_index(self):
+        self._index.write(_INDEX_MAGIC)
+        for type_id, (name, version) in enumerate(self._keys):
+            name = codecs.encode(name, 'utf-8')
+            self._index.write(
+                _INDEX_TYPE.pack('T', type_id, version, len(name)))
+            self._index.write(name)
+        for ordinal in xrange(len(self._offsets)):
+            self._index.write(_INDEX_ENTRY.pack(
+                'E', self._offsets[ordinal], self._lengths[ordinal],
+                self._types[ordinal]))
+
+    def _end(self):
+        if not self._offsets:
+            return 0
+        return self._offsets[-1] + self._lengths[-1]
+
+    def _buffer(self):
+        if self._map is None:
+            self._data.seek(0, os.SEEK_END)
+            if self._data.tell() == 0:
+                return None
+            self._map = mmap.mmap(
+                self._data.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._map
+
+    def _add(self, offset, length, message):
+        key = (message.name, message.version)
+        type_id = self._type_ids.get(key)
+        if type_id is None:
+            type_id = self._type_ids[key] = len(self._keys)
+            self._keys.append(key)
+            if self.mode == 'a':
+                name = codecs.encode(message.name, 'utf-8')
+                self._index.write(
+                    _INDEX_TYPE.pack('T', type_id, message.version, len(name)))
+                self._index.write(name)
+        self._offsets.append(offset)
+        self._lengths.append(length)
+        self._types.append(type_id)
+        if self.mode == 'a':
+            self._index.write(_INDEX_ENTRY.pack('E', offset, length, type_id))
+
+    def _flush_index(self):
+        if self.mode == 'a':
+            self._index.flush()
+
+    def __len__(self):
+        """
+        Return the number of messages in the log.
+        """
+        return len(self._offsets)
+
+    def append(self, message, values):
+        """
+        Append an instance of `message` to the log, with field
+        values taken from the dictionary `values` (as for
+        :func:`encode_file`), and return its ordinal.
+        """
+        if self.mode != 'a':
+            raise SendlibError('log is not open for appending')
+        offset = self._end()
+        self._data.seek(offset, 0)
+        try:
+            message.encode(self._data, values)
+        except:
+            # drop what was written of the message, so the log
+            # still ends with the last complete one
+            self._data.seek(offset, 0)
+            self._data.truncate()
+            raise
+        length = self._data.tell() - offset
+        self._map = None
+        self._add(offset, length, message)
+        ordinal = len(self._offsets) - 1
+        for index in self._field_indexes.itervalues():
+            if index.message == message:
+                self._index_values(index, ordinal, values)
+        return ordinal
+
+    def entry(self, ordinal):
+        """
+        Return a tuple of ``(offset, length, message)`` for the
+        message at `ordinal`, where `message` is a
+        :class:`Message`.
+        """
+        key = self._keys[self._types[ordinal]]
+        return self._offsets[ordinal], self._lengths[ordinal], \
+               self.registry[key]
+
+    def reader(self, ordinal):
+        """
+        Return a :class:`Reader` for the message at `ordinal`,
+        reading directly from the memory-mapped log.
+        """
+        offset, length, message = self.entry(ordinal)
+        if self.mode == 'a':
+            self._data.flush()
+        stream = _BufferStream(self._buffer(), offset, offset + length)
+        return message.reader(stream)
+
+    def read(self, ordinal):
+        """
+        Return a dictionary of the field values of the message at
+        `ordinal`, as for :func:`decode_file`.
+        """
+        return _read_values(self.reader(ordinal))
+
+    def select(self, *messages):
+        """
+        Yield the ordinals of all messages in the log which are
+        instances of any of `messages`, consulting only the index.
+        """
+        wanted = set()
+        for message in messages:
+            type_id = self._type_ids.get((message.name, message.version))
+            if type_id is not None:
+                wanted.add(type_id)
+        for ordinal, type_id in enumerate(self._types):
+            if type_id in wanted:
+                yield ordinal
+
+    def find(self, message, field_name, value):
+        """
+        Return a list of the ordinals of instances of `message`
+        whose field `field_name` has the given `value`, in the
+        order they were appended. The field must have been named
+        in the `indexes` given when opening the log.
+        """
+        key = (message.name, message.version, field_name)
+        if key not in self._field_indexes:
+            raise SendlibError(
+                'field "%s" of message (%s, %d) is not indexed' %
+                (field_name, message.name, message.version))
+        return sorted(self._field_indexes[key].find(_index_key(value)))
+
+    def flush(self):
+        """
+        Flush appended messages and their index entries to disk.
+        """
+        if self.mode == 'a':
+            self._data.flush()
+            self._flush_index()
+            for index in self._field_indexes.itervalues():
+                index.save(len(self))
+
+    def close(self):
+        """
+        Flush and close the log.
+        """
+        self.flush()
+        self._map = None
+        self._data.close()
+        if self._index:
+            self._index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+class Connection(object):
+    """
+    :class:`Connection` wraps a connected socket with buffered
+    file objects for reading and writing messages. Connections are
+    ordinarily obtained from a :class:`ConnectionPool`.
+
+    .. py:attribute:: sock
+
+       The underlying socket
+    """
+
+    __slots__ = ('sock', 'rfile', 'wfile', 'last_used')
+    def __init__(self, sock, bufsize=64 * 1024):
+        self.sock = sock
+        self.rfile = sock.makefile('rb', bufsize)
+        self.wfile = sock.makefile('wb', bufsize)
+        self.last_used = time.time()
+
+    def send(self, message, values):
+        """
+        Write an instance of `message` with the given `values` (a
+        dictionary or :class:`Record`) as for :meth:`Message.encode`.
+        The message is buffered until :meth:`flush` is called.
+        """
+        message.encode(self.wfile, values)
+
+    def receive(self, message, record=False):
+        """
+        Read and return an instance of `message`, as for
+        :meth:`Message.decode`.
+        """
+        return message.decode(self.rfile, record=record)
+
+    def flush(self):
+        """
+        Send any buffered messages.
+        """
+        self.wfile.flush()
+
+    def pipeline(self, requests, record=False):
+        """
+        Send several requests back to back, then read one reply
+        for each, in order. `requests` is a sequence of tuples of
+        ``(message, values, reply_message)``; returns a list of
+        the decoded replies (see :meth:`receive`).
+        """
+        requests = list(requests)
+        for message, values, reply in requests:
+            self.send(message, values)
+        self.flush()
+        return [self.receive(reply, record) for _, _, reply in requests]
+
+    def healthy(self):
+        """
+        Return ``True`` if the connection appears usable: it is
+        open, and the peer has neither closed it nor sent data
+        that has not been read.
+        """
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            if readable:
+                return False
+        except (select.error, socket.error, ValueError):
+            return False
+        return True
+
+    def close(self):
+        """
+        Close the connection.
+        """
+        for closeable in (self.rfile, self.wfile, self.sock):
+            try:
+                closeable.close()
+            except (socket.error, EnvironmentError):
+                pass
+
+class ConnectionPool(object):
+    """
+    :class:`ConnectionPool` keeps up to `max_size` connections
+    open for reuse. `connect` is either an ``(address, port)``
+    tuple, or a callable returning a new connected socket.
+
+    Idle connections are checked with :meth:`Connection.healthy`
+    before they are handed out, and closed if they have been idle
+    for more than `max_idle` seconds (if given). When all
+    `max_size` connections are in use, :meth:`acquire` waits for
+    one to be released.
+    """
+
+    __slots__ = ('connect', 'max_size', 'max_idle', '_idle', '_size',
+                 '_cond')
+    def __init__(self, connect, max_size=8, max_idle=None):
+        if isinstance(connect, tuple):
+            address = connect
+            connect = lambda: socket.create_connection(address)
+        self.connect = connect
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self._idle = []
+        self._size = 0
+        self._cond = threading.Condition()
+
+    def acquire(self, timeout=None):
+        """
+        Return an idle, healthy :class:`Connection`, or a new one
+        if there are fewer than `max_size`, waiting up to
+        `timeout` seconds (or forever, if ``None``) for one to be
+        released otherwise. Raises :class:`SendlibError` if the
+        timeout expires.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        with self._cond:
+            while True:
+                while self._idle:
+                    conn = self._idle.pop()
+                    stale = self.max_idle is not None and \
+                            time.time() - conn.last_used > self.max_idle
+                    if not stale and conn.healthy():
+                        return conn
+                    conn.close()
+                    self._size -= 1
+                if self._size < self.max_size:
+                    self._size += 1
+                    break
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise SendlibError('no connection available')
+                self._cond.wait(remaining)
+        try:
+            return Connection(self.connect())
+        except:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, discard=False):
+        """
+        Return `conn` to the pool, or, if `discard` is true, close
+        it and free its place.
+        """
+        with self._cond:
+            if discard:
+                conn.close()
+                self._size -= 1
+            else:
+                conn.last_used = time.time()
+                self._idle.append(conn)
+            self._cond.notify()
+
+    @contextlib.contextmanager
+    def connection(self, timeout=None):
+        """
+        A context manager which acquires a connection, and releases
+        it on exit, or discards it if an exception was raised.
+        """
+        conn = self.acquire(timeout)
+        try:
+            yield conn
+        except:
+            self.release(conn, discard=True)
+            raise
+        self.release(conn)
+
+    def pipeline(self, requests, record=False):
+        """
+        Run :meth:`Connection.pipeline` on a pooled connection.
+        """
+        with self.connection() as conn:
+            return conn.pipeline(requests, record)
+
+    def close(self):
+        """
+        Close all idle connections.
+        """
+        with self._cond:
+            while self._idle:
+                self._idle.pop().close()
+                self._size -= 1
+
+def _read_exactly(stream, size):
+    parts = []
+    while size > 0:
+        part = stream.read(size)
+        if not part:
+            break
+        parts.append(part)
+        size -= len(part)
+    return ''.join(parts)
+
+_FRAME = struct.Struct('>cLL')
+class Channel(object):
+    """
+    A :class:`Channel` is a file-like object for one logical stream
+    of a :class:`Multiplexer`, suitable for passing to
+    :meth:`Message.reader` and :meth:`Message.writer`. Writes are
+    buffered into frames of at most the multiplexer's
+    `frame_size`, and sent no faster than the peer grants credit;
+    call :meth:`flush` to send any partial frame.
+
+    You ordinarily obtain a :class:`Channel` by calling
+    :meth:`Multiplexer.channel` or :meth:`Multiplexer.accept`.
+
+    .. py:attribute:: id
+
+       The stream id of the channel
+    """
+
+    __slots__ = ('mux', 'id', '_rbuf', '_rpos', '_eof', '_consumed',
+                 '_credit', '_wbuf', '_wpos')
+    def __init__(self, mux, id):
+        self.mux = mux
+        self.id = id
+        self._rbuf = ''
+        self._rpos = 0
+        self._eof = False
+        self._consumed = 0
+        self._credit = mux.window
+        self._wbuf = ''
+        self._wpos = 0
+
+    def _buffered(self):
+        return len(self._rbuf) - self._rpos
+
+    def _take(self, size):
+        # remove and return up to `size` buffered bytes, and return
+        # credit to the peer once half the window has been consumed
+        out = self._rbuf[self._rpos:self._rpos + size]
+        self._rpos += len(out)
+        self._consumed += len(out)
+        ack = 0
+        if self._consumed >= self.mux.window // 2:
+            ack, self._consumed = self._consumed, 0
+        return out, ack
+
+    def _read(self, size, line):
+        # take buffered data, a window's worth at a time, until
+        # `size` bytes (or a line, if `line`) have been read
+        mux = self.mux
+        parts = []
+        remaining = size if size is not None and size >= 0 else None
+        while remaining != 0:
+            with mux._cond:
+                while not self._eof and not self._buffered():
+                    mux._pump()
+                amount = self._buffered()
+                if line:
+                    newline = self._rbuf.find('\n', self._rpos)
+                    if newline != -1:
+                        amount = newline + 1 - self._rpos
+                if remaining is not None:
+                    amount = min(amount, remaining)
+                out, ack = self._take(amount)
+            if ack:
+                mux._send_frame('w', self.id, ack)
+            if not out:
+                break
+            parts.append(out)
+            if remaining is not None:
+                remaining -= len(out)
+            if line and out[-1] == '\n':
+                break
+        return ''.join(parts)
+
+    def read(self, size=-1):
+        """
+        Read `size` bytes (or, if `size` is negative, all bytes
+        until the peer closes the channel), or fewer if the channel
+        is closed first.
+        """
+        return self._read(size, False)
+
+    def readline(self, size=-1):
+        """
+        Read up to and including the next new line character, but
+        not more than `size` bytes, if `size` is not negative.
+        """
+        return self._read(size, True)
+
+    def write(self, data):
+        """
+        Buffer `data` for sending, sending complete frames as soon
+        as the peer has granted enough credit.
+        """
+        self._wbuf = self._wbuf[self._wpos:] + data
+        self._wpos = 0
+        while len(self._wbuf) - self._wpos >= self.mux.frame_size:
+            self._send(self.mux.frame_size)
+
+    def _send(self, size):
+        mux = self.mux
+        with mux._cond:
+            while self._credit <= 0:
+                if mux._closed:
+                    raise SendlibError('connection closed')
+                mux._pump()
+            size = min(size, self._credit)
+            self._credit -= size
+        payload = self._wbuf[self._wpos:self._wpos + size]
+        self._wpos += size
+        mux._send_frame('d', self.id, len(payload), payload)
+
+    def flush(self):
+        """
+        Send all buffered data.
+        """
+        while self._wpos < len(self._wbuf):
+            self._send(len(self._wbuf) - self._wpos)
+        self.mux._flush()
+
+    def close(self):
+        """
+        Send all buffered data, and signal the end of the channel
+        to the peer.
+        """
+        self.flush()
+        self.mux._send_frame('e', self.id, 0)
+        self.mux._flush()
+
+class Multiplexer(object):
+    """
+    :class:`Multiplexer` carries any number of independent
+    :class:`Channel` streams over one connection, reading from
+    `rfile` and writing to `wfile` (for instance, the files of a
+    :class:`Connection`). Each channel's data is sent in frames
+    tagged with its stream id, so that messages on one channel,
+    including large ``data`` fields, do not hold up messages on
+    the others when written from different threads.
+
+    Flow control is per channel: a sender may have at most
+    `window` bytes outstanding which the receiving application has
+    not yet read, so a slow reader of one channel never forces the
+    other end to buffer without bound.
+
+    Both ends must use the same `window`. Channels are identified
+    by integer ids, which the two ends must agree on (for instance,
+    by one end using odd ids and the other even ones).
+    """
+
+    __slots__ = ('rfile', 'wfile', 'window', 'frame_size', '_channels',
+                 '_accepted', '_cond', '_wlock', '_reading', '_closed')
+    def __init__(self, rfile, wfile, window=256 * 1024, frame_size=16 * 1024):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.window = window
+        self.frame_size = frame_size
+        self._channels = {}
+        self._accepted = []
+        self._cond = threading.Condition()
+        self._wlock = threading.Lock()
+        self._reading = False
+        self._closed = False
+
+    def channel(self, id):
+        """
+        Return the :class:`Channel` with stream id `id`, creating
+        it if necessary.
+        """
+        with self._cond:
+            return self._channel(id, accept=False)
+
+    def accept(self):
+        """
+        Wait for the peer to open a new channel, and return it, or
+        return ``None`` if the connection is closed first.
+        """
+        with self._cond:
+            while not self._accepted:
+                if self._closed:
+                    return None
+                self._pump()
+            return self._accepted.pop(0)
+
+    def _channel(self, id, accept):
+        channel = self._channels.get(id)
+        if channel is None:
+            channel = self._channels[id] = Channel(self, id)
+            channel._eof = self._closed
+            if accept:
+                self._accepted.append(channel)
+        return channel
+
+    def _send_frame(self, kind, id, length, payload=''):
+        with self._wlock:
+            self.wfile.write(_FRAME.pack(kind, id, length))
+            if payload:
+                self.wfile.write(payload)
+
+    def _flush(self):
+        with self._wlock:
+            self.wfile.flush()
+
+    def _pump(self):
+        # with _cond held, read and dispatch one frame, or
+        # wait for the thread which is already doing so
+        if self._closed:
+            return
+        if self._reading:
+            self._cond.wait()
+            return
+        self._reading = True
+        self._cond.release()
+        frame = None
+        try:
+            # the peer may be waiting on anything we have buffered
+            self._flush()
+            header = _read_exactly(self.rfile, _FRAME.size)
+            if len(header) == _FRAME.size:
+                kind, id, length = _FRAME.unpack(header)
+                payload = ''
+                if kind == 'd':
+                    payload = _read_exactly(self.rfile, length)
+                if len(payload) == length or kind != 'd':
+                    frame = kind, id, length, payload
+        finally:
+            self._cond.acquire()
+            self._reading = False
+            self._cond.notify_all()
+
+        if frame is None:
+            self._closed = True
+            for channel in self._channels.itervalues():
+                channel._eof = True
+            return
+        kind, id, length, payload = frame
+        channel = self._channel(id, accept=True)
+        if kind == 'd':
+            if channel._buffered() + length > self.window:
+                raise SendlibError(
+                    'peer exceeded flow control window on channel %d' % id)
+            channel._rbuf = channel._rbuf[channel._rpos:] + payload
+            channel._rpos = 0
+        elif kind == 'e':
+            channel._eof = True
+        elif kind == 'w':
+            channel._credit += length
+        else:
+            raise SendlibError('unknown frame type "%s"' % kind)
+
+class OutputBuffer(object):
+    """
+    :class:`OutputBuffer` is a file-like object which buffers
+    writes to `stream` (a file-like object or a socket, which may
+    be non-blocking) up to a bound, for use with
+    :meth:`Message.writer`.
+
+    Once more than `high_water` bytes are buffered, the buffer is
+    considered :attr:`full`. If `block` is true, the write which
+    filled it then sends data to `stream`, waiting for it to become
+    writable as necessary, until no more than `low_water` bytes
+    remain. Otherwise, writes are always accepted, and the producer
+    should stop writing new messages while the buffer is full, and
+    call :meth:`send_pending` whenever `stream` is writable. In
+    either case, `on_drain` (if given) is called with no arguments
+    when a full buffer drains to `low_water` bytes.
+
+    Buffered writes are kept as a list of segments: runs of small
+    writes are joined into one segment when sent, while writes of
+    16KB or more (such as large ``str`` fields) are kept by
+    reference and never copied. Each segment is sent to a socket
+    or file descriptor (`stream` may be one) with its own call.
+
+    .. py:attribute:: stalls
+
+       The number of times the buffer has become full
+
+    .. py:attribute:: stall_time
+
+       The total time in seconds the buffer has spent full
+    """
+
+    __slots__ = ('stream', 'high_water', 'low_water', 'on_drain', 'block',
+                 'stalls', 'stall_time', '_chunks', '_offset', '_size',
+                 '_full_since')
+    def __init__(self, stream, high_water=1024 * 1024, low_water=None,
+                 on_drain=None, block=True):
+        self.stream = stream
+        self.high_water = high_water
+        if low_water is None:
+            low_water = high_water // 4
+        self.low_water = low_water
+        self.on_drain = on_drain
+        self.block = block
+        self.stalls = 0
+        self.stall_time = 0.0
+        self._chunks = []
+        self._offset = 0
+        self._size = 0
+        self._full_since = None
+
+    @property
+    def full(self):
+        """
+        ``True`` from when more than `high_water` bytes are buffered
+        until the buffer drains to `low_water` bytes.
+        """
+        return self._full_since is not None
+
+    def buffered(self):
+        """
+        Return the number of bytes buffered but not yet sent.
+        """
+        return self._size
+
+    def write(self, data):
+        """
+        Buffer `data`, draining the buffer first if it is full and
+        `block` is true.
+        """
+        if not data:
+            return
+        self._chunks.append(data)
+        self._size += len(data)
+        if self._size > self.high_water and self._full_since is None:
+            self._full_since = time.time()
+            self.stalls += 1
+        if self._full_since is not None and self.block:
+            self._drain(self.low_water, True)
+
+    def send_pending(self):
+        """
+        Send as much buffered data as `stream` accepts without
+        blocking, and return the number of bytes still buffered.
+        """
+        self._drain(0, False)
+        return self._size
+
+    def flush(self):
+        """
+        Send all buffered data, waiting as necessary, and flush
+        `stream` if it has a ``flush`` method.
+        """
+        self._drain(0, True)
+        if hasattr(self.stream, 'flush'):
+            self.stream.flush()
+
+    def _gather(self):
+        # join runs of small chunks, leaving large ones as they are,
+        # and return the segments to send, the first of which may
+        # have been partially sent already
+        segments = []
+        small = []
+        for chunk in self._chunks:
+            if len(chunk) >= _COPY_LIMIT or \
+               not segments and not small and self._offset:
+                if small:
+                    segments.append(''.join(small))
+                    small = []
+                segments.append(chunk)
+            else:
+                small.append(chunk)
+        if small:
+            segments.append(''.join(small))
+        self._chunks = segments
+        segments = list(segments)
+        if self._offset:
+            segments[0] = memoryview(segments[0])[self._offset:]
+        return segments
+
+    def _drain(self, target, wait):
+        while self._size > target:
+            sent = self._send(self._gather(), wait)
+            if sent is None:
+                break
+            self._size -= sent
+            sent += self._offset
+            while self._chunks and sent >= len(self._chunks[0]):
+                sent -= len(self._chunks.pop(0))
+            self._offset = sent
+        if self._full_since is not None and self._size <= self.low_water:
+            self.stall_time += time.time() - self._full_since
+            self._full_since = None
+            if self.on_drain is not None:
+                self.on_drain()
+
+    def _send(self, segments, wait):
+        # returns the number of bytes sent, or None if the
+        # stream would block and `wait` is false
+        isfd = isinstance(self.stream, (int, long))
+        if not isfd and not hasattr(self.stream, 'send'):
+            for segment in segments:
+                self.stream.write(segment)
+            return sum(len(segment) for segment in segments)
+        while True:
+            try:
+                if isfd:
+                    return os.write(self.stream, segments[0])
+                return self.stream.send(segments[0])
+            except (socket.error, OSError), e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+            if not wait:
+                return None
+            select.select([], [self.stream], [])
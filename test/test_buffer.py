@@ -0,0 +1,199 @@
+import fcntl
+import os
+import socket
+import threading
+import unittest
+from StringIO import StringIO
+
+import sendlib
+
+class OutputBufferTest(unittest.TestCase):
+
+    definition = """
+    (chunk, 1):
+      - seq: int
+      - body: str
+    """
+
+    def setUp(self):
+        self.registry = sendlib.parse(self.definition)
+        self.chunk = self.registry[('chunk', 1)]
+
+    def test_blocking(self):
+        out = StringIO()
+        buf = sendlib.OutputBuffer(out, high_water=100, low_water=10)
+        expected = StringIO()
+        for i in xrange(20):
+            self.chunk.encode(buf, {'seq': i, 'body': 'x' * 20})
+            self.chunk.encode(expected, {'seq': i, 'body': 'x' * 20})
+            self.assertTrue(buf.buffered() <= 100)
+        self.assertTrue(buf.stalls > 0)
+        self.assertFalse(buf.full)
+        buf.flush()
+        self.assertEqual(0, buf.buffered())
+        self.assertEqual(expected.getvalue(), out.getvalue())
+
+    def test_nonblocking(self):
+        client, server = socket.socketpair()
+        client.setblocking(0)
+        drained = []
+        buf = sendlib.OutputBuffer(client, high_water=64 * 1024,
+                                   on_drain=lambda: drained.append(1),
+                                   block=False)
+        count = 0
+        while not buf.full:
+            self.chunk.encode(buf, {'seq': count, 'body': 'x' * 1000})
+            count += 1
+        self.assertEqual(1, buf.stalls)
+        self.assertEqual([], drained)
+
+        received = []
+        def consume():
+            while True:
+                data = server.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+
+        while buf.send_pending():
+            pass
+        self.assertEqual([1], drained)
+        self.assertFalse(buf.full)
+        self.assertTrue(buf.stall_time > 0)
+        client.close()
+        consumer.join()
+        server.close()
+
+        stream = StringIO(''.join(received))
+        for i in xrange(count):
+            self.assertEqual(i, self.chunk.decode(stream)['seq'])
+
+    def test_blocking_socket(self):
+        client, server = socket.socketpair()
+        client.setblocking(0)
+        buf = sendlib.OutputBuffer(client, high_water=16 * 1024)
+
+        received = []
+        def consume():
+            while True:
+                data = server.recv(65536)
+                if not data:
+                    break
+                received.append(data)
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+
+        for i in xrange(1000):
+            self.chunk.encode(buf, {'seq': i, 'body': 'y' * 1000})
+            self.assertTrue(buf.buffered() <= 16 * 1024 + 1000)
+        buf.flush()
+        client.close()
+        consumer.join()
+        server.close()
+
+        stream = StringIO(''.join(received))
+        for i in xrange(1000):
+            self.assertEqual(i, self.chunk.decode(stream)['seq'])
+
+class SegmentTest(unittest.TestCase):
+
+    definition = """
+    (chunk, 1):
+      - seq: int
+      - body: str
+    """
+
+    def setUp(self):
+        self.registry = sendlib.parse(self.definition)
+        self.chunk = self.registry[('chunk', 1)]
+
+    def test_large_writes_not_copied(self):
+        class Recorder(object):
+            def __init__(self):
+                self.writes = []
+            def write(self, data):
+                self.writes.append(data)
+
+        out = Recorder()
+        buf = sendlib.OutputBuffer(out)
+        payload = 'z' * 100000
+        self.chunk.encode(buf, {'seq': 1, 'body': payload})
+        self.chunk.encode(buf, {'seq': 2, 'body': 'small'})
+        buf.flush()
+
+        # one segment before the payload, the payload itself,
+        # and one for the whole second message
+        self.assertEqual(3, len(out.writes))
+        self.assertTrue(out.writes[1] is payload)
+        stream = StringIO(''.join(out.writes))
+        self.assertEqual(payload, self.chunk.decode(stream)['body'])
+        self.assertEqual('small', self.chunk.decode(stream)['body'])
+
+    def test_partial_sends(self):
+        client, server = socket.socketpair()
+        client.setblocking(0)
+        buf = sendlib.OutputBuffer(client, high_water=64 * 1024)
+
+        received = []
+        def consume():
+            while True:
+                data = server.recv(4096)
+                if not data:
+                    break
+                received.append(data)
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+
+        for i in xrange(50):
+            self.chunk.encode(buf, {'seq': i, 'body': chr(65 + i) * 50000})
+        buf.flush()
+        client.close()
+        consumer.join()
+        server.close()
+
+        stream = StringIO(''.join(received))
+        for i in xrange(50):
+            self.assertEqual({'seq': i, 'body': chr(65 + i) * 50000},
+                             self.chunk.decode(stream))
+
+    def test_file_descriptor(self):
+        r, w = os.pipe()
+        buf = sendlib.OutputBuffer(w)
+        self.chunk.encode(buf, {'seq': 7, 'body': 'x' * 20000})
+        buf.flush()
+        os.close(w)
+        with os.fdopen(r, 'rb') as fp:
+            self.assertEqual({'seq': 7, 'body': 'x' * 20000},
+                             self.chunk.decode(fp))
+
+    def test_nonblocking_file_descriptor(self):
+        r, w = os.pipe()
+        fcntl.fcntl(w, fcntl.F_SETFL,
+                    fcntl.fcntl(w, fcntl.F_GETFL) | os.O_NONBLOCK)
+        buf = sendlib.OutputBuffer(w, block=False)
+        for i in xrange(10):
+            self.chunk.encode(buf, {'seq': i, 'body': chr(65 + i) * 50000})
+        # the pipe fills up long before everything is sent
+        self.assertTrue(buf.send_pending())
+        received = []
+        def consume():
+            while True:
+                data = os.read(r, 65536)
+                if not data:
+                    break
+                received.append(data)
+        thread = threading.Thread(target=consume)
+        thread.start()
+        buf.flush()
+        os.close(w)
+        thread.join()
+        os.close(r)
+        stream = StringIO(''.join(received))
+        for i in xrange(10):
+            self.assertEqual({'seq': i, 'body': chr(65 + i) * 50000},
+                             self.chunk.decode(stream))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+import os
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import sendlib
+
+class BulkTest(unittest.TestCase):
+
+    definition = """
+    (point, 1):
+      - x: int
+      - y: int
+
+    (record, 1):
+      - id: int
+      - name: str
+      - note: str or nil
+      - tags: many str
+      - origin: msg (point, 1)
+      - path: many msg (point, 1)
+    """
+
+    def records(self, count):
+        for i in xrange(count):
+            yield {
+                'id': i,
+                'name': 'record %d' % i,
+                'note': 'even' if i % 2 == 0 else None,
+                'tags': ['t%d' % i, 'x'],
+                'origin': {'x': i, 'y': i + 1},
+                'path': [{'x': 1, 'y': 2}] * (i % 3),
+            }
+
+    def test_encode_matches_writer(self):
+        msgs = sendlib.parse(self.definition)
+        record = msgs[('record', 1)]
+
+        serial = StringIO()
+        sendlib.encode_file(record, self.records(10), serial, workers=1)
+        parallel = StringIO()
+        sendlib.encode_file(record, self.records(10), parallel,
+                            workers=2, batch_size=3)
+        self.assertEqual(serial.getvalue(), parallel.getvalue())
+
+        expected = StringIO()
+        writer = record.writer(expected)
+        writer.write('id', 0)
+        writer.write('name', 'record 0')
+        writer.write('note', 'even')
+        writer.write('tags', ['t0', 'x'])
+        origin = writer.write('origin')
+        origin.write('x', 0)
+        origin.write('y', 1)
+        writer.write('path', [])
+        self.assertTrue(serial.getvalue().startswith(expected.getvalue()))
+
+    def test_round_trip(self):
+        msgs = sendlib.parse(self.definition)
+        record = msgs[('record', 1)]
+
+        buf = StringIO()
+        sendlib.encode_file(record, self.records(25), buf, workers=2)
+        buf.seek(0, 0)
+        decoded = list(sendlib.decode_file(record, buf, workers=2,
+                                           batch_bytes=100))
+        self.assertEqual(list(self.records(25)), decoded)
+
+    def test_decode_mmap(self):
+        msgs = sendlib.parse(self.definition)
+        record = msgs[('record', 1)]
+
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                sendlib.encode_file(record, self.records(5), fp, workers=1)
+            with open(path, 'rb') as fp:
+                decoded = list(sendlib.decode_file(record, fp, workers=1))
+            self.assertEqual(list(self.records(5)), decoded)
+        finally:
+            os.unlink(path)
+
+    def test_truncated(self):
+        msgs = sendlib.parse(self.definition)
+        record = msgs[('record', 1)]
+
+        buf = StringIO()
+        sendlib.encode_file(record, self.records(2), buf, workers=1)
+        truncated = StringIO(buf.getvalue()[:-3])
+        self.assertRaises(sendlib.SendlibError, list,
+                          sendlib.decode_file(record, truncated, workers=1))
+
+    def test_data_fields(self):
+        definition = """
+        (blob, 1):
+          - name: str
+          - body: data
+        """
+        msgs = sendlib.parse(definition)
+        blob = msgs[('blob', 1)]
+
+        records = [{'name': 'a', 'body': StringIO('first')},
+                   {'name': 'b', 'body': StringIO('second')}]
+        buf = StringIO()
+        sendlib.encode_file(blob, records, buf, workers=1)
+        buf.seek(0, 0)
+        decoded = list(sendlib.decode_file(blob, buf, workers=1))
+        self.assertEqual([{'name': 'a', 'body': 'first'},
+                          {'name': 'b', 'body': 'second'}], decoded)
+
+if __name__ == '__main__':
+    unittest.main()
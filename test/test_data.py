@@ -1,6 +1,10 @@
+import os
+import string
+import subprocess
+import sys
+import tempfile
 import unittest
 import sendlib
-import string
 from StringIO import StringIO
 
 class DataTest(unittest.TestCase):
@@ -163,16 +167,324 @@ class DataTest(unittest.TestCase):
                 return self.length
 
         class NullStream(object):
-            def write(self, data): pass
+            def __init__(self):
+                self.written = []
+            def write(self, data):
+                if len(self.written) < 2:
+                    self.written.append(data)
 
         msgs = sendlib.parse(self.definition)
         msg = msgs[('msg', 1)]
 
-        writer = msg.writer(NullStream())
+        stream = NullStream()
+        writer = msg.writer(stream)
         writer.write('data', LongData(4294967295))
+        self.assertEqual('D\xff\xff\xff\xff', stream.written[1])
+
+        # longer data is written in chunks
+        stream = NullStream()
+        writer = msg.writer(stream)
+        writer.write('data', LongData(4294967296))
+        self.assertEqual('C', stream.written[1])
+
+class DataIterationTest(unittest.TestCase):
+
+    definition = """
+    (msg, 1):
+      - data: data
+      - after: str
+    """
+
+    def setUp(self):
+        self.msg = sendlib.parse(self.definition)[('msg', 1)]
+        self.lines = ['%d,%s\n' % (i, 'x' * (i % 50)) for i in xrange(10000)]
+        self.lines.append('no newline')
+
+        buf = StringIO()
+        writer = self.msg.writer(buf)
+        writer.write('data', StringIO(''.join(self.lines)))
+        writer.write('after', 'end')
+
+        class Stream(object):
+            # has neither readline nor seek
+            def __init__(self, data):
+                self.buf = StringIO(data)
+            def read(self, size):
+                return self.buf.read(size)
+        self.stream = Stream(buf.getvalue())
+        self.reader = self.msg.reader(self.stream)
+
+    def test_iter(self):
+        data = self.reader.read('data')
+        self.assertEqual(self.lines, list(data))
+        self.assertEqual(0, data.bytes_remaining())
+        self.assertEqual('end', self.reader.read('after'))
+
+    def test_mixed(self):
+        data = self.reader.read('data')
+        self.assertEqual(self.lines[0], data.readline())
+        self.assertEqual(self.lines[1][:2], data.readline(2))
+        self.assertEqual(self.lines[1][2:] + self.lines[2][:3], data.read(
+            len(self.lines[1]) - 2 + 3))
+        self.assertEqual(self.lines[2][3:], data.readline())
+        self.assertEqual(self.lines[3:4], data.readlines(1))
+
+        buf = bytearray(10)
+        self.assertEqual(10, data.readinto(buf))
+        rest = str(buf) + ''.join(data.iter_chunks(1000))
+        self.assertEqual(''.join(self.lines[4:]), rest)
+        self.assertEqual(0, data.readinto(buf))
+        self.assertEqual('end', self.reader.read('after'))
+
+    def test_skip_unseekable(self):
+        data = self.reader.read('data')
+        data.readline()
+        self.assertRaises(Exception, self.reader.read, 'after')
+        data.skip()
+        self.assertEqual(0, data.bytes_remaining())
+        self.assertEqual('end', self.reader.read('after'))
+
+    def test_skip_data(self):
+        reads = []
+        stream = self.stream
+        class Recording(object):
+            def readinto(self, buf):
+                data = stream.read(len(buf))
+                reads.append(len(buf))
+                buf[:len(data)] = data
+                return len(data)
+            def read(self, size):
+                return stream.read(size)
+
+        reader = self.msg.reader(Recording(), skip_data=True)
+        data = reader.read('data')
+        self.assertEqual(self.lines[0], data.readline())
+        self.assertEqual('end', reader.read('after'))
+        self.assertTrue(reads)
+        self.assertTrue(max(reads) <= 64 * 1024)
+
+    def test_copy_to(self):
+        proxy = sendlib.parse("""
+        (proxied, 1):
+          - body: data
+        """)[('proxied', 1)]
+        forwarded = StringIO()
+        writer = proxy.writer(forwarded)
+
+        class Sink(object):
+            def __init__(self):
+                self.chunks = []
+            def write(self, data):
+                self.chunks.append(data)
+
+        data = self.reader.read('data')
+        first = data.readline()
+        sinks = [Sink(), Sink()]
+        with writer.data_writer('body') as out:
+            copied = data.copy_to(sinks[0], sinks[1], out, chunk_size=4096)
+        self.assertEqual('end', self.reader.read('after'))
+
+        rest = ''.join(self.lines)[len(first):]
+        self.assertEqual(len(rest), copied)
+        for sink in sinks:
+            self.assertEqual(rest, ''.join(sink.chunks))
+            self.assertTrue(max(map(len, sink.chunks)) <= 4096)
+        # each chunk is read once, and the same string written to each sink
+        for a, b in zip(*[sink.chunks for sink in sinks]):
+            self.assertTrue(a is b)
+
+        forwarded.seek(0, 0)
+        self.assertEqual({'body': rest}, proxy.decode(forwarded))
+        self.assertRaises(TypeError, data.copy_to, Sink(), size=1)
+
+class DataSourceTest(unittest.TestCase):
+
+    definition = """
+    (msg, 1):
+      - data: data
+      - after: str
+    """
+
+    def setUp(self):
+        self.msg = sendlib.parse(self.definition)[('msg', 1)]
 
-        writer = msg.writer(NullStream())
-        self.assertRaises(sendlib.SendlibError, writer.write, 'data', LongData(4294967296))
+    def roundtrip(self, value):
+        buf = StringIO()
+        writer = self.msg.writer(buf)
+        writer.write('data', value)
+        writer.write('after', 'end')
+        buf.seek(0, 0)
+        return self.msg.decode(buf)
+
+    def test_seeks_once(self):
+        class Counting(StringIO):
+            seeks = 0
+            def seek(self, *args):
+                Counting.seeks += 1
+                return StringIO.seek(self, *args)
+
+        source = Counting('some data')
+        self.assertEqual({'data': 'some data', 'after': 'end'},
+                         self.roundtrip(source))
+        self.assertEqual(2, Counting.seeks)
+
+    def test_pipe(self):
+        # pipes' file objects have seek and tell methods, which fail
+        for wrap in (lambda pipe: pipe, sendlib.DataSource):
+            proc = subprocess.Popen(
+                [sys.executable, '-c', 'print "some data"'],
+                stdout=subprocess.PIPE)
+            try:
+                self.assertEqual({'data': 'some data\n', 'after': 'end'},
+                                 self.roundtrip(wrap(proc.stdout)))
+            finally:
+                proc.stdout.close()
+                proc.wait()
+
+    def test_unseekable(self):
+        class Pipe(object):
+            def __init__(self, data):
+                self.buf = StringIO(data)
+            def read(self, size):
+                return self.buf.read(min(size, 3))
+
+        source = sendlib.DataSource(Pipe('some data and more'), 9)
+        self.assertEqual({'data': 'some data', 'after': 'end'},
+                         self.roundtrip(source))
+        source = sendlib.DataSource(Pipe('some data and more'))
+        self.assertEqual(None, source.length)
+        self.assertEqual({'data': 'some data and more', 'after': 'end'},
+                         self.roundtrip(source))
+
+    def test_buffers(self):
+        self.assertEqual({'data': 'bytes', 'after': 'end'},
+                         self.roundtrip(sendlib.DataSource('bytes')))
+        self.assertEqual({'data': 'array', 'after': 'end'},
+                         self.roundtrip(bytearray('array')))
+        self.assertEqual({'data': 'view', 'after': 'end'},
+                         self.roundtrip(memoryview('a view')[2:]))
+
+    def test_iterable(self):
+        chunks = ['one', 'two', 'three']
+        self.assertRaises(sendlib.SendlibError, sendlib.DataSource, object())
+        self.assertEqual({'data': 'onetwothree', 'after': 'end'},
+                         self.roundtrip(c for c in chunks))
+        self.assertEqual({'data': 'onetwothree', 'after': 'end'},
+                         self.roundtrip(sendlib.DataSource(iter(chunks), 11)))
+
+        writer = self.msg.writer(StringIO())
+        self.assertRaises(sendlib.SendlibError, writer.write, 'data',
+                          sendlib.DataSource(iter(chunks), 12))
+        writer = self.msg.writer(StringIO())
+        self.assertRaises(sendlib.SendlibError, writer.write, 'data',
+                          sendlib.DataSource(iter(chunks), 10))
+
+    def test_file_descriptor(self):
+        fp = tempfile.TemporaryFile()
+        fp.write('header:contents')
+        fp.flush()
+        os.lseek(fp.fileno(), 7, os.SEEK_SET)
+        self.assertEqual({'data': 'contents', 'after': 'end'},
+                         self.roundtrip(sendlib.DataSource(fp.fileno())))
+        fp.close()
+
+        r, w = os.pipe()
+        os.write(w, 'piped')
+        os.close(w)
+        self.assertEqual(None, sendlib.DataSource(r).length)
+        self.assertEqual({'data': 'piped', 'after': 'end'},
+                         self.roundtrip(sendlib.DataSource(r)))
+        os.close(r)
+
+class ChunkedDataTest(unittest.TestCase):
+
+    definition = """
+    (msg, 1):
+      - id: int
+      - data: data or nil
+      - after: str
+    """
+
+    def setUp(self):
+        self.msg = sendlib.parse(self.definition)[('msg', 1)]
+        self.lines = ['line %d\n' % i for i in xrange(5000)]
+
+        self.buf = StringIO()
+        writer = self.msg.writer(self.buf)
+        writer.write('id', 1)
+        with writer.data_writer('data') as out:
+            for line in self.lines:
+                out.write(line)
+            out.write('x' * 20000)
+        writer.write('after', 'end')
+        self.buf.seek(0, 0)
+
+    def test_write(self):
+        buf = StringIO()
+        writer = self.msg.writer(buf)
+        writer.write('id', 2)
+        out = writer.data_writer('data')
+        out.write('abc')
+        out.close()
+        writer.write('after', 'end')
+        self.assertEqual(
+            'MS\x00\x00\x00\x03msgI\x00\x00\x00\x01I\x00\x00\x00\x02'
+            'C\x00\x00\x00\x03abc\x00\x00\x00\x00S\x00\x00\x00\x03end',
+            buf.getvalue())
+
+        writer = self.msg.writer(StringIO())
+        writer.write('id', 3)
+        self.assertRaises(sendlib.SendlibError, writer.data_writer, 'after')
+
+        # the data must end before the next field
+        buf = StringIO()
+        writer = self.msg.writer(buf)
+        writer.write('id', 4)
+        out = writer.data_writer('data')
+        out.write('abc')
+        self.assertRaises(sendlib.SendlibError, writer.write, 'after', 'end')
+        self.assertRaises(sendlib.SendlibError, writer.write_all,
+                          {'after': 'end'})
+        out.close()
+        writer.write('after', 'end')
+        buf.seek(0, 0)
+        self.assertEqual({'id': 4, 'data': 'abc', 'after': 'end'},
+                         self.msg.decode(buf))
+
+    def test_read(self):
+        reader = self.msg.reader(self.buf)
+        self.assertEqual(1, reader.read('id'))
+        data = reader.read('data')
+        self.assertEqual(None, data.length)
+        for line in self.lines:
+            self.assertEqual(line, data.readline())
+        self.assertEqual('x' * 10, data.read(10))
+        self.assertRaises(Exception, reader.read, 'after')
+        self.assertEqual('x' * 19990, data.read())
+        self.assertEqual(len(''.join(self.lines)) + 20000, data.length)
+        self.assertEqual('', data.read())
+        self.assertEqual('end', reader.read('after'))
+
+    def test_skip(self):
+        reader = self.msg.reader(self.buf)
+        reader.read('id')
+        reader.read('data').skip()
+        self.assertEqual('end', reader.read('after'))
+
+        self.buf.seek(0, 0)
+        self.assertEqual({'id': 1, 'after': 'end'},
+                         self.msg.decode(self.buf, fields=['id', 'after']))
+
+    def test_view_and_random_access(self):
+        expected = ''.join(self.lines) + 'x' * 20000
+        view = self.msg.view(self.buf.getvalue())
+        self.assertEqual('end', view['after'])
+        self.assertEqual(expected, view['data'].read())
+
+        reader = self.msg.reader(self.buf, random_access=True)
+        self.assertEqual('end', reader.read('after'))
+        self.assertEqual(expected, reader.read('data').read())
+        self.assertEqual('', self.buf.read())
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,216 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import sendlib
+
+class MessageLogTest(unittest.TestCase):
+
+    definition = """
+    (login, 1):
+      - user: str
+      - ok: bool
+
+    (logout, 1):
+      - user: str
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'messages.log')
+        self.registry = sendlib.parse(self.definition)
+        self.login = self.registry[('login', 1)]
+        self.logout = self.registry[('logout', 1)]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write_log(self):
+        with sendlib.MessageLog.open(self.path, self.registry, 'a') as log:
+            self.assertEqual(0, log.append(self.login, {'user': 'a', 'ok': True}))
+            self.assertEqual(1, log.append(self.logout, {'user': 'a'}))
+            self.assertEqual(2, log.append(self.login, {'user': 'b', 'ok': False}))
+
+    def test_random_access(self):
+        self.write_log()
+        with sendlib.MessageLog.open(self.path, self.registry) as log:
+            self.assertEqual(3, len(log))
+            self.assertEqual({'user': 'b', 'ok': False}, log.read(2))
+            self.assertEqual({'user': 'a'}, log.read(1))
+            offset, length, message = log.entry(1)
+            self.assertEqual(self.logout, message)
+            self.assertEqual('a', log.reader(0).read('user'))
+
+    def test_select(self):
+        self.write_log()
+        with sendlib.MessageLog.open(self.path, self.registry) as log:
+            self.assertEqual([0, 2], list(log.select(self.login)))
+            self.assertEqual([1], list(log.select(self.logout)))
+            self.assertEqual([0, 1, 2],
+                             list(log.select(self.login, self.logout)))
+
+    def test_sequential_read(self):
+        self.write_log()
+        with open(self.path, 'rb') as fp:
+            reader = self.login.reader(fp)
+            self.assertEqual('a', reader.read('user'))
+            self.assertEqual(True, reader.read('ok'))
+            reader = self.logout.reader(fp)
+            self.assertEqual('a', reader.read('user'))
+
+    def test_append_after_reopen(self):
+        self.write_log()
+        with sendlib.MessageLog.open(self.path, self.registry, 'a') as log:
+            self.assertEqual(3, log.append(self.logout, {'user': 'b'}))
+            self.assertEqual({'user': 'b'}, log.read(3))
+        with sendlib.MessageLog.open(self.path, self.registry) as log:
+            self.assertEqual(4, len(log))
+            self.assertEqual([1, 3], list(log.select(self.logout)))
+
+    def test_failed_append(self):
+        self.write_log()
+        with sendlib.MessageLog.open(self.path, self.registry, 'a') as log:
+            self.assertRaises(sendlib.SendlibError, log.append,
+                              self.login, {'user': 'c' * 50, 'ok': 'yes'})
+            self.assertEqual(3, log.append(self.logout, {'user': 'c'}))
+        for mode in ('r', 'a'):
+            with sendlib.MessageLog.open(self.path, self.registry,
+                                         mode) as log:
+                self.assertEqual(4, len(log))
+                self.assertEqual({'user': 'c'}, log.read(3))
+
+    def test_rebuild_index(self):
+        self.write_log()
+        os.unlink(self.path + '.idx')
+        with sendlib.MessageLog.open(self.path, self.registry) as log:
+            self.assertEqual(3, len(log))
+            self.assertEqual([1], list(log.select(self.logout)))
+
+        # a partial trailing message is dropped in append mode
+        with open(self.path, 'ab') as fp:
+            fp.write('MS\x00\x00\x00\x06logout')
+        with sendlib.MessageLog.open(self.path, self.registry, 'a') as log:
+            self.assertEqual(3, len(log))
+            log.append(self.logout, {'user': 'c'})
+        with sendlib.MessageLog.open(self.path, self.registry) as log:
+            self.assertEqual(4, len(log))
+            self.assertEqual({'user': 'c'}, log.read(3))
+
+    def test_rebuild_index_unknown_message(self):
+        self.write_log()
+        os.unlink(self.path + '.idx')
+        size = os.path.getsize(self.path)
+        registry = sendlib.parse("""
+        (login, 1):
+          - user: str
+          - ok: bool
+        """)
+        self.assertRaises(sendlib.SendlibError, sendlib.MessageLog.open,
+                          self.path, registry, 'a')
+        self.assertEqual(size, os.path.getsize(self.path))
+
+        # as is a corrupt message
+        with open(self.path, 'r+b') as fp:
+            fp.seek(size - 2, 0)
+            fp.write('X')
+        with open(self.path, 'ab') as fp:
+            fp.write('MS\x00\x00\x00\x05login')
+        self.assertRaises(sendlib.SendlibError, sendlib.MessageLog.open,
+                          self.path, self.registry, 'a')
+        self.assertEqual(size + 11, os.path.getsize(self.path))
+
+    def test_read_only(self):
+        self.write_log()
+        with sendlib.MessageLog.open(self.path, self.registry) as log:
+            self.assertRaises(sendlib.SendlibError, log.append,
+                              self.logout, {'user': 'c'})
+
+class FieldIndexTest(unittest.TestCase):
+
+    definition = """
+    (event, 1):
+      - user_id: int
+      - key: str or nil
+      - payload: str
+    """
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'events.log')
+        self.registry = sendlib.parse(self.definition)
+        self.event = self.registry[('event', 1)]
+        self.indexes = [(self.event, 'user_id'), (self.event, 'key')]
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def open(self, mode='r', indexes=None):
+        if indexes is None:
+            indexes = self.indexes
+        return sendlib.MessageLog.open(self.path, self.registry, mode, indexes)
+
+    def test_find(self):
+        with self.open('a') as log:
+            for i in xrange(20):
+                log.append(self.event, {
+                    'user_id': i % 3,
+                    'key': 'k%d' % (i % 2) if i % 5 else None,
+                    'payload': 'p%d' % i,
+                })
+            # pending entries are found before they are saved
+            self.assertEqual([1, 4, 7, 10, 13, 16, 19],
+                             log.find(self.event, 'user_id', 1))
+
+        with self.open() as log:
+            self.assertEqual([1, 4, 7, 10, 13, 16, 19],
+                             log.find(self.event, 'user_id', 1))
+            self.assertEqual([1, 3, 7, 9, 11, 13, 17, 19],
+                             log.find(self.event, 'key', 'k1'))
+            self.assertEqual([], log.find(self.event, 'user_id', 7))
+            for ordinal in log.find(self.event, 'user_id', 2):
+                self.assertEqual(2, log.reader(ordinal).read('user_id'))
+
+    def test_find_after_reopen(self):
+        with self.open('a') as log:
+            log.append(self.event, {'user_id': 5, 'payload': 'a'})
+        with self.open('a') as log:
+            log.append(self.event, {'user_id': 5, 'payload': 'b'})
+            log.append(self.event, {'user_id': 6, 'payload': 'c'})
+        with self.open() as log:
+            self.assertEqual([0, 1], log.find(self.event, 'user_id', 5))
+            self.assertEqual([2], log.find(self.event, 'user_id', 6))
+
+    def test_catch_up(self):
+        with self.open('a', indexes=()) as log:
+            log.append(self.event, {'user_id': 5, 'payload': 'a'})
+            log.append(self.event, {'user_id': 6, 'payload': 'b'})
+        with self.open() as log:
+            self.assertEqual([1], log.find(self.event, 'user_id', 6))
+
+    def test_unsafe_field_name(self):
+        registry = sendlib.parse("""
+        (event, 1):
+          - user/id: int
+        """)
+        event = registry[('event', 1)]
+        indexes = [(event, 'user/id')]
+        with sendlib.MessageLog.open(self.path, registry, 'a',
+                                     indexes) as log:
+            log.append(event, {'user/id': 5})
+        self.assertEqual(['events.log', 'events.log.event-1.user_id.idx',
+                          'events.log.idx'], sorted(os.listdir(self.dir)))
+        with sendlib.MessageLog.open(self.path, registry,
+                                     indexes=indexes) as log:
+            self.assertEqual([0], log.find(event, 'user/id', 5))
+
+    def test_invalid_index(self):
+        self.assertRaises(sendlib.SendlibError, self.open, 'a',
+                          [(self.event, 'nonexistent')])
+        with self.open('a', indexes=()) as log:
+            log.append(self.event, {'user_id': 5, 'payload': 'a'})
+            self.assertRaises(sendlib.SendlibError, log.find,
+                              self.event, 'user_id', 5)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import socket
+import threading
+import unittest
+from StringIO import StringIO
+
+import sendlib
+
+class MultiplexerTest(unittest.TestCase):
+
+    definition = """
+    (upload, 1):
+      - name: str
+      - body: data
+
+    (ping, 1):
+      - seq: int
+    """
+
+    def setUp(self):
+        self.registry = sendlib.parse(self.definition)
+        self.upload = self.registry[('upload', 1)]
+        self.ping = self.registry[('ping', 1)]
+        client, server = socket.socketpair()
+        self.socks = client, server
+        self.client = sendlib.Multiplexer(
+            client.makefile('rb'), client.makefile('wb'), window=64 * 1024)
+        self.server = sendlib.Multiplexer(
+            server.makefile('rb'), server.makefile('wb'), window=64 * 1024)
+
+    def tearDown(self):
+        for sock in self.socks:
+            sock.close()
+
+    def test_no_head_of_line_blocking(self):
+        body = 'x' * (2 * 1024 * 1024)
+        started = threading.Event()
+
+        def send_upload():
+            channel = self.client.channel(1)
+            writer = self.upload.writer(channel)
+            writer.write('name', 'big')
+            channel.flush()
+            started.set()
+            writer.write('body', StringIO(body))
+            channel.close()
+        uploader = threading.Thread(target=send_upload)
+        uploader.start()
+        started.wait()
+
+        # the ping is readable long before the upload completes,
+        # which cannot proceed past one window without the server
+        # reading it
+        channel = self.client.channel(3)
+        self.ping.encode(channel, {'seq': 1})
+        channel.flush()
+
+        first = self.server.accept()
+        second = self.server.accept()
+        self.assertEqual((1, 3), (first.id, second.id))
+        self.assertEqual({'seq': 1}, self.ping.decode(second))
+        self.assertTrue(uploader.is_alive())
+
+        reader = self.upload.reader(first)
+        self.assertEqual('big', reader.read('name'))
+        self.assertEqual(body, reader.read('body').read())
+        uploader.join()
+        self.assertEqual('', first.read())
+
+    def test_both_directions(self):
+        def serve():
+            channel = self.server.accept()
+            request = self.ping.decode(channel)
+            self.ping.encode(channel, {'seq': request['seq'] + 1})
+            channel.close()
+        server = threading.Thread(target=serve)
+        server.start()
+
+        channel = self.client.channel(5)
+        self.ping.encode(channel, {'seq': 41})
+        channel.flush()
+        self.assertEqual({'seq': 42}, self.ping.decode(channel))
+        server.join()
+
+    def test_readline(self):
+        channel = self.client.channel(1)
+        channel.write('first line\nsecond')
+        channel.close()
+
+        channel = self.server.accept()
+        self.assertEqual('first line\n', channel.readline())
+        self.assertEqual('sec', channel.readline(3))
+        self.assertEqual('ond', channel.readline())
+        self.assertEqual('', channel.readline())
+
+    def test_connection_closed(self):
+        self.socks[0].shutdown(socket.SHUT_RDWR)
+        self.assertEqual(None, self.server.accept())
+        self.assertEqual('', self.server.channel(1).read(10))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+import socket
+import threading
+import unittest
+
+import sendlib
+
+class NetTest(unittest.TestCase):
+
+    definition = """
+    (auth, 1):
+      - username: str
+      - password: str
+
+    (authreply, 1):
+      - success: bool
+      - message: str or nil
+    """
+
+    def setUp(self):
+        self.registry = sendlib.parse(self.definition)
+        self.auth = self.registry[('auth', 1)]
+        self.authreply = self.registry[('authreply', 1)]
+        self.servers = []
+
+    def tearDown(self):
+        for thread in self.servers:
+            thread.join()
+
+    def serve(self, sock):
+        # answer auth requests until the client hangs up
+        def run():
+            conn = sendlib.Connection(sock)
+            try:
+                while True:
+                    try:
+                        request = conn.receive(self.auth)
+                    except Exception:
+                        break
+                    ok = request['password'] == 'secret'
+                    conn.send(self.authreply, {
+                        'success': ok,
+                        'message': None if ok else request['username']})
+                    conn.flush()
+            finally:
+                conn.close()
+        thread = threading.Thread(target=run)
+        thread.start()
+        self.servers.append(thread)
+
+    def connect(self):
+        client, server = socket.socketpair()
+        self.serve(server)
+        return client
+
+    def test_pipeline(self):
+        pool = sendlib.ConnectionPool(self.connect)
+        requests = [(self.auth, {'username': 'u%d' % i,
+                                 'password': 'secret' if i % 2 else 'x'},
+                     self.authreply) for i in xrange(10)]
+        replies = pool.pipeline(requests)
+        self.assertEqual(10, len(replies))
+        self.assertEqual({'success': False, 'message': 'u0'}, replies[0])
+        self.assertEqual({'success': True, 'message': None}, replies[1])
+        self.assertEqual('u8', replies[8]['message'])
+
+        Reply = self.authreply.record_class()
+        self.assertEqual([Reply(True, None)], pool.pipeline(
+            [(self.auth, {'username': 'a', 'password': 'secret'},
+              self.authreply)], record=True))
+        pool.close()
+
+    def test_reuse(self):
+        created = []
+        def connect():
+            created.append(1)
+            return self.connect()
+
+        pool = sendlib.ConnectionPool(connect, max_size=2)
+        for i in xrange(3):
+            with pool.connection() as conn:
+                conn.send(self.auth, {'username': 'a', 'password': 'b'})
+                conn.flush()
+                conn.receive(self.authreply)
+        self.assertEqual(1, len(created))
+
+        first = pool.acquire()
+        second = pool.acquire()
+        self.assertEqual(2, len(created))
+        self.assertRaises(sendlib.SendlibError, pool.acquire, 0.01)
+        pool.release(first)
+        pool.release(second)
+        pool.close()
+
+    def test_health_check(self):
+        pool = sendlib.ConnectionPool(self.connect)
+        conn = pool.acquire()
+        self.assertTrue(conn.healthy())
+        pool.release(conn)
+
+        # the server hangs up when the connection is shut down
+        conn.sock.shutdown(socket.SHUT_WR)
+        self.servers[0].join()
+        self.assertFalse(conn.healthy())
+        other = pool.acquire()
+        self.assertFalse(other is conn)
+        pool.release(other)
+        pool.close()
+
+    def test_discard_on_error(self):
+        pool = sendlib.ConnectionPool(self.connect, max_size=1)
+        try:
+            with pool.connection() as conn:
+                raise ValueError
+        except ValueError:
+            pass
+        other = pool.acquire(0.01)
+        self.assertFalse(other is conn)
+        pool.release(other)
+        pool.close()
+
+if __name__ == '__main__':
+    unittest.main()
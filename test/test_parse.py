@@ -186,6 +186,36 @@ class ParserTest(unittest.TestCase):
         foo = msgs.get_message('f o o')
         self.assertEqual('ba r', foo.fields[0].name)
 
+    def test_defaults(self):
+        definition = """
+        (foo, 1):
+         - a: int = 5
+         - b: str or nil = "x y"
+         - c: bool = false
+         - d: float = -1.5
+         - e: int or nil = nil
+         - f: int
+        """
+
+        foo = sendlib.parse(definition)[('foo', 1)]
+        self.assertEqual([5, u'x y', False, -1.5, None, sendlib.Nothing],
+                         [field.default for field in foo.fields])
+        self.assertEqual(('int', ), foo.fields[0].types)
+        self.assertEqual(('str', 'nil'), foo.fields[1].types)
+
+        self.assertRaises(sendlib.ParseError, sendlib.parse, """
+        (foo, 1):
+         - a: int = "x"
+        """)
+        self.assertRaises(sendlib.ParseError, sendlib.parse, """
+        (foo, 1):
+         - a: int = nil
+        """)
+        self.assertRaises(sendlib.ParseError, sendlib.parse, """
+        (foo, 1):
+         - a: int = five
+        """)
+
 if __name__ == '__main__':
     unittest.main()
 
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import sys
 from StringIO import StringIO
 import unittest
 
@@ -54,6 +55,52 @@ class SerializationTest(unittest.TestCase):
         expected = 'MS\x00\x00\x00\x03fooI\x00\x00\x00\x01S\x00\x00\x00\x03BARNS\x00\x00\x00\x03QUX'
         self.assertEqual(expected, buf.getvalue())
 
+    def test_skip_nil_fields(self):
+        definition = """
+        (foo, 1):
+          - a: int or nil
+          - b: str or nil
+          - c: int
+          - d: int or nil
+          - e: int or nil
+          - f: bool or nil
+        """
+        msg = sendlib.parse(definition)[('foo', 1)]
+        header = 'MS\x00\x00\x00\x03fooI\x00\x00\x00\x01'
+
+        class Stream(StringIO):
+            writes = 0
+            def write(self, data):
+                Stream.writes += 1
+                StringIO.write(self, data)
+
+        buf = Stream()
+        writer = msg.writer(buf)
+        writer.write('c', 1)
+        writer.write('f', True)
+        self.assertEqual(header + 'NNI\x00\x00\x00\x01NNBt', buf.getvalue())
+        # the header, each run of nils, and each value
+        self.assertEqual(5, Stream.writes)
+
+        writer = msg.writer(StringIO())
+        self.assertRaises(sendlib.SendlibError, writer.write, 'd', 1)
+        writer.write('a', 1)
+        self.assertRaises(sendlib.SendlibError, writer.write, 'a', 1)
+
+        buf = Stream()
+        Stream.writes = 0
+        msg.writer(buf).write_all({'c': 2, 'e': 3})
+        self.assertEqual(header + 'NNI\x00\x00\x00\x02NI\x00\x00\x00\x03N',
+                         buf.getvalue())
+        self.assertEqual(6, Stream.writes)
+
+        buf = StringIO()
+        writer = msg.writer(buf)
+        writer.write('a', 4)
+        writer.write_all({'a': 5, 'c': 6})
+        self.assertEqual(header + 'I\x00\x00\x00\x04NI\x00\x00\x00\x06NNN',
+                         buf.getvalue())
+
     def test_fields_write_in_order(self):
         definition = """
         (foo, 1):
@@ -464,6 +511,892 @@ class SerializationTest(unittest.TestCase):
 
         self.assertEqual(expected, buf.getvalue())
 
+    def test_read_nested_message(self):
+        definition = """
+        (foo, 1):
+         - a: str
+         - b: str
+
+        (bar, 1):
+         - c: int
+
+        (baz, 1):
+         - m: msg(foo, 1) or msg(bar, 1)
+         - after: str
+        """
+        registry = sendlib.parse(definition)
+        baz = registry.get_message('baz')
+
+        buf = StringIO()
+        writer = baz.writer(buf)
+        barwriter = writer.write('m', registry.get_message('bar'))
+        barwriter.write('c', 5)
+        writer.write('after', 'done')
+
+        buf.seek(0, 0)
+        reader = baz.reader(buf)
+        barreader = reader.read('m')
+        self.assertEqual(registry.get_message('bar'), barreader.message)
+        self.assertEqual(5, barreader.read('c'))
+        self.assertEqual('done', reader.read('after'))
+        self.assertRaises(sendlib.SendlibError, reader.read, 'after')
+
+    def test_read_many(self):
+        definition = """
+        (file, 1):
+         - filename: str
+
+        (files, 1):
+         - names: many str
+         - files: many msg (file, 1)
+        """
+        msgs = sendlib.parse(definition)
+        files = msgs[('files', 1)]
+
+        buf = StringIO()
+        writer = files.writer(buf)
+        writer.write('names', ['a', 'b'])
+        subwriters = writer.write('files', [msgs.get_message('file')] * 2)
+        for i, filewriter in enumerate(subwriters):
+            filewriter.write('filename', 'f%d' % i)
+
+        buf.seek(0, 0)
+        reader = files.reader(buf)
+        self.assertEqual(['a', 'b'], reader.read('names'))
+        names = [r.read('filename') for r in reader.read('files')]
+        self.assertEqual(['f0', 'f1'], names)
+        self.assertEqual('', buf.read())
+
+
+    def test_skip(self):
+        definition = """
+        (point, 1):
+         - x: int
+         - y: float
+
+        (foo, 1):
+         - a: str
+         - b: many int
+         - c: msg (point, 1)
+         - d: data
+         - e: bool
+         - f: str
+        """
+        msgs = sendlib.parse(definition)
+        foo = msgs[('foo', 1)]
+
+        buf = StringIO()
+        writer = foo.writer(buf)
+        writer.write('a', 'x' * 100)
+        writer.write('b', [1, 2, 3])
+        point = writer.write('c')
+        point.write('x', 1)
+        point.write('y', 2.5)
+        writer.write('d', StringIO('some data'))
+        writer.write('e', True)
+        writer.write('f', 'last')
+        serialized = buf.getvalue()
+
+        class Unseekable(object):
+            def __init__(self, data):
+                self.buf = StringIO(data)
+            def read(self, size=-1):
+                return self.buf.read(size)
+
+        for stream in (StringIO(serialized), Unseekable(serialized)):
+            reader = foo.reader(stream)
+            reader.skip('a')
+            self.assertRaises(sendlib.SendlibError, reader.skip, 'c')
+            reader.skip('b')
+            reader.skip('c')
+            reader.skip('d')
+            self.assertEqual(True, reader.read('e'))
+            self.assertEqual('last', reader.read('f'))
+            self.assertEqual('', stream.read())
+
+        reader = foo.reader(StringIO(serialized))
+        self.assertEqual('x' * 100, reader.read('a'))
+        self.assertRaises(sendlib.SendlibError, reader.skip_to, 'a')
+        reader.skip_to('f')
+        self.assertEqual('last', reader.read('f'))
+
+    def test_decode(self):
+        definition = """
+        (point, 1):
+         - x: int
+         - y: int
+
+        (foo, 1):
+         - id: int
+         - name: str
+         - origin: msg (point, 1)
+         - body: data
+         - ts: int
+        """
+        msgs = sendlib.parse(definition)
+        foo = msgs[('foo', 1)]
+
+        buf = StringIO()
+        for i in xrange(2):
+            writer = foo.writer(buf)
+            writer.write('id', i)
+            writer.write('name', 'name%d' % i)
+            point = writer.write('origin')
+            point.write('x', 1)
+            point.write('y', 2)
+            writer.write('body', StringIO('body'))
+            writer.write('ts', 100 + i)
+
+        buf.seek(0, 0)
+        self.assertEqual({'id': 0, 'name': 'name0', 'origin': {'x': 1, 'y': 2},
+                          'body': 'body', 'ts': 100}, foo.decode(buf))
+        self.assertEqual({'id': 1, 'ts': 101},
+                         foo.decode(buf, fields=['id', 'ts']))
+        self.assertEqual('', buf.read())
+
+
+    def test_record_class(self):
+        definition = """
+        (foo, 1):
+         - id: int
+         - full name: str or nil
+        """
+        msgs = sendlib.parse(definition)
+        foo = msgs[('foo', 1)]
+
+        Foo = foo.record_class()
+        self.assertTrue(Foo is foo.record_class())
+        self.assertTrue(issubclass(Foo, sendlib.Record))
+        self.assertEqual(('id', 'full_name'), Foo.__slots__)
+
+        record = Foo(1, full_name='A B')
+        self.assertEqual(1, record.id)
+        self.assertEqual('A B', record.get('full name'))
+        self.assertEqual(None, Foo(2).full_name)
+        self.assertEqual(Foo(1, 'A B'), record)
+        self.assertNotEqual(Foo(1, 'A C'), record)
+        self.assertRaises(TypeError, Foo, 1, 2, 3)
+        self.assertRaises(TypeError, Foo, bogus=1)
+
+    def test_record_field_named_get(self):
+        msg = sendlib.parse("""
+        (lookup, 1):
+         - get: int
+         - key: str
+        """)[('lookup', 1)]
+        Lookup = msg.record_class()
+        record = Lookup(3, u'k')
+        self.assertEqual(3, record.get)
+        self.assertEqual(u'k', sendlib.Record.get(record, 'key'))
+        buf = StringIO()
+        msg.encode(buf, record)
+        self.assertEqual(len(buf.getvalue()), msg.encoded_size(record))
+        buf.seek(0, 0)
+        self.assertEqual(record, msg.decode(buf, record=True))
+
+    def test_encode_decode_records(self):
+        definition = """
+        (foo, 1):
+         - a: str
+
+        (bar, 1):
+         - b: int
+
+        (baz, 1):
+         - id: int
+         - m: msg (foo, 1) or msg (bar, 1)
+         - ms: many msg (bar, 1)
+         - note: str or nil
+        """
+        msgs = sendlib.parse(definition)
+        Foo = msgs[('foo', 1)].record_class()
+        Bar = msgs[('bar', 1)].record_class()
+        baz = msgs[('baz', 1)]
+        Baz = baz.record_class()
+
+        record = Baz(7, Bar(3), [Bar(1), Bar(2)])
+        buf = StringIO()
+        baz.encode(buf, record)
+        baz.encode(buf, {'id': 8, 'm': Foo('x'), 'ms': [{'b': 4}]})
+
+        buf.seek(0, 0)
+        self.assertEqual(record, baz.decode(buf, record=True))
+        decoded = baz.decode(buf, record=True)
+        self.assertEqual(Baz(8, Foo('x'), [Bar(4)]), decoded)
+        self.assertEqual('', buf.read())
+
+        buf.seek(0, 0)
+        self.assertEqual(Baz(7, None, None, None),
+                         baz.decode(buf, fields=['id'], record=True))
+
+        # dicts are ambiguous for fields with several message types
+        self.assertRaises(sendlib.SendlibError, baz.encode, StringIO(),
+                          {'id': 1, 'm': {'a': 'x'}, 'ms': []})
+
+
+    def test_encoded_size(self):
+        definition = """
+        (point, 1):
+         - x: int
+         - y: float or nil
+
+        (foo, 1):
+         - id: int
+         - name: str or nil
+         - flag: bool
+         - origin: msg (point, 1)
+         - path: many msg (point, 1) or nil
+         - tags: many str
+         - body: data
+        """
+        msgs = sendlib.parse(definition)
+        foo = msgs[('foo', 1)]
+        Point = msgs[('point', 1)].record_class()
+
+        values = [
+            {'id': 1, 'name': u'caf\xe9', 'flag': True,
+             'origin': {'x': 1, 'y': 2.5},
+             'path': [Point(1), {'x': 2, 'y': None}],
+             'tags': ['a', 'bc'], 'body': StringIO('body')},
+            {'id': 2L, 'flag': False, 'origin': Point(0),
+             'tags': [], 'body': StringIO('')},
+        ]
+        for value in values:
+            buf = StringIO()
+            size = foo.encoded_size(value)
+            foo.encode(buf, value)
+            self.assertEqual(len(buf.getvalue()), size)
+
+
+    def test_view(self):
+        definition = """
+        (point, 1):
+         - x: int
+         - y: int
+
+        (foo, 1):
+         - id: int
+         - full name: str
+         - origin: msg (point, 1)
+         - path: many msg (point, 1)
+         - tags: many str
+         - body: data
+         - note: str or nil
+        """
+        msgs = sendlib.parse(definition)
+        foo = msgs[('foo', 1)]
+        Point = msgs[('point', 1)].record_class()
+
+        buf = StringIO()
+        buf.write('junk')
+        foo.encode(buf, {'id': 3, 'full name': 'A B',
+                         'origin': Point(1, 2),
+                         'path': [Point(3, 4), Point(5, 6)],
+                         'tags': ['a', 'b'],
+                         'body': StringIO('body')})
+        serialized = buf.getvalue() + 'trailing'
+
+        view = foo.view(serialized, 4)
+        self.assertEqual(len(serialized) - len('trailing'), view._end)
+        self.assertEqual(foo, view._message)
+
+        # fields may have the names of attributes of other objects
+        reply = sendlib.parse('''
+        (reply, 1):
+         - message: str or nil
+         - buf: int
+         - end: int
+        ''')[('reply', 1)]
+        out = StringIO()
+        reply.encode(out, {'message': u'hi', 'buf': 1, 'end': 2})
+        other = reply.view(out.getvalue())
+        self.assertEqual((u'hi', 1, 2), (other.message, other.buf, other.end))
+        self.assertEqual(None, view.note)
+        self.assertEqual('A B', view['full name'])
+        self.assertEqual('A B', view.full_name)
+        self.assertEqual(3, view.id)
+        self.assertEqual(['a', 'b'], view.tags)
+        self.assertTrue(view.tags is view.tags)
+        self.assertEqual(2, view.origin.y)
+        self.assertEqual([4, 6], [p.y for p in view.path])
+        self.assertEqual('body', view.body.read())
+        self.assertEqual('body', view.body.read())
+        self.assertRaises(KeyError, lambda: view['bogus'])
+        self.assertRaises(AttributeError, lambda: view.bogus)
+
+        self.assertRaises(sendlib.SendlibError, foo.view, serialized[:30], 4)
+        self.assertRaises(sendlib.SendlibError,
+                          msgs[('point', 1)].view, serialized, 4)
+
+
+    def test_random_access(self):
+        definition = """
+        (point, 1):
+         - x: int
+         - y: int
+
+        (foo, 1):
+         - id: int
+         - body: data
+         - origin: msg (point, 1)
+         - path: many msg (point, 1)
+         - tags: many str
+         - name: str
+        """
+        msgs = sendlib.parse(definition)
+        foo = msgs[('foo', 1)]
+        Point = msgs[('point', 1)].record_class()
+
+        buf = StringIO()
+        foo.encode(buf, {'id': 3, 'body': StringIO('x' * 10000),
+                         'origin': Point(1, 2),
+                         'path': [Point(3, 4), Point(5, 6)],
+                         'tags': ['a', 'b'], 'name': 'last'})
+        end = buf.tell()
+        buf.write('trailing')
+
+        buf.seek(0, 0)
+        reader = foo.reader(buf, random_access=True)
+        self.assertEqual('last', reader.read('name'))
+        self.assertEqual(end, buf.tell())
+        self.assertEqual(3, reader.read('id'))
+        self.assertEqual('last', reader.read('name'))
+        self.assertEqual(['a', 'b'], reader.read('tags'))
+
+        origin = reader.read('origin')
+        self.assertEqual(2, origin.read('y'))
+        self.assertEqual(1, origin.read('x'))
+        self.assertEqual([4, 6], [p.read('y') for p in reader.read('path')])
+
+        body = reader.read('body')
+        self.assertEqual('xxxx', body.read(4))
+        self.assertEqual(3, reader.read('id'))
+        self.assertEqual('x' * 9996, body.read())
+        self.assertEqual(end, buf.tell())
+        self.assertEqual('trailing', buf.read())
+
+        self.assertRaises(sendlib.SendlibError, reader.read, 'bogus')
+
+    def test_versions(self):
+        definition = """
+        (auth, 1):
+         - username: str
+         - password: str
+         - attachment: data
+         - legacy: int
+
+        (auth, 2):
+         - username: str
+         - attachment: data
+         - retries: int = 3
+         - token: str or nil
+
+        (auth, 3):
+         - password: str
+         - username: str
+
+        (auth, 4):
+         - username: str
+         - attachment: data
+        """
+        msgs = sendlib.parse(definition)
+        auth1, auth2, auth3, auth4 = [msgs[('auth', v)] for v in (1, 2, 3, 4)]
+
+        buf = StringIO()
+        for i in xrange(2):
+            auth1.encode(buf, {'username': 'user%d' % i, 'password': 'pw',
+                               'attachment': StringIO('x' * 100),
+                               'legacy': 7})
+        auth2.encode(buf, {'username': 'new', 'attachment': StringIO('y'),
+                           'retries': 1, 'token': 't'})
+
+        buf.seek(0, 0)
+        reader = auth2.reader(buf)
+        self.assertEqual('user0', reader.read('username'))
+        attachment = reader.read('attachment')
+        self.assertEqual('x' * 100, attachment.read())
+        self.assertEqual(3, reader.read('retries'))
+        self.assertEqual(None, reader.read('token'))
+        self.assertRaises(sendlib.SendlibError, reader.read, 'token')
+
+        self.assertEqual({'username': 'user1', 'attachment': 'x' * 100,
+                          'retries': 3, 'token': None}, auth2.decode(buf))
+        self.assertEqual({'username': 'new', 'attachment': 'y',
+                          'retries': 1, 'token': 't'}, auth2.decode(buf))
+        self.assertEqual('', buf.read())
+
+        # a trailing removed field after a data field
+        buf = StringIO()
+        auth1.encode(buf, {'username': 'u', 'password': 'pw',
+                           'attachment': StringIO('z' * 10), 'legacy': 7})
+        auth1.encode(buf, {'username': 'v', 'password': 'pw',
+                           'attachment': StringIO('w' * 5), 'legacy': 7})
+        buf.seek(0, 0)
+        Auth2 = auth2.record_class()
+        self.assertEqual(Auth2('u', None, 3, None),
+                         auth2.decode(buf, fields=['username', 'retries'],
+                                      record=True))
+        reader = auth4.reader(buf)
+        reader.skip_to('attachment')
+        attachment = reader.read('attachment')
+        # the data is streamed, and the fields after it skipped
+        # once it is read
+        self.assertEqual('w' * 5, attachment.read())
+        self.assertEqual('', buf.read())
+
+        # reordered fields cannot be transcoded
+        buf.seek(0, 0)
+        self.assertRaises(sendlib.SendlibError, auth3.decode, buf)
+        # and new fields need defaults
+        buf = StringIO()
+        auth2.encode(buf, {'username': 'u', 'attachment': StringIO('')})
+        buf.seek(0, 0)
+        self.assertRaises(sendlib.SendlibError, auth1.decode, buf)
+
+    def test_relay(self):
+        definition = """
+        (point, 1):
+         - x: int
+         - y: float or nil
+
+        (foo, 1):
+         - id: int
+         - body: data
+         - chunks: data
+         - origin: msg (point, 1)
+         - path: many msg (point, 1)
+         - tags: many str
+         - flag: bool
+
+        (foo, 2):
+         - id: int
+         - body: data
+         - chunks: data
+         - origin: msg (point, 1)
+         - path: many msg (point, 1)
+         - tags: many str
+         - flag: bool
+        """
+        msgs = sendlib.parse(definition)
+        foo = msgs[('foo', 1)]
+        point = msgs[('point', 1)]
+        Point = point.record_class()
+
+        buf = StringIO()
+        for i in xrange(3):
+            foo.encode(buf, {'id': i, 'body': StringIO('b' * 10000 * i),
+                             'chunks': ('c' * 1000 for j in xrange(30)),
+                             'origin': Point(1, 2.5),
+                             'path': [Point(3), Point(5, 6.0)],
+                             'tags': ['tag', 'x' * 20000],
+                             'flag': True})
+        point.encode(buf, {'x': 7})
+        original = buf.getvalue()
+
+        buf.seek(0, 0)
+        out = StringIO()
+        relayed = []
+        while True:
+            message = msgs.relay(buf, out)
+            if message is None:
+                break
+            relayed.append(message)
+        self.assertEqual([foo] * 3 + [point], relayed)
+        self.assertEqual(original, out.getvalue())
+
+        # the header may be rewritten, or the message dropped
+        foo2 = msgs[('foo', 2)]
+        def rewrite(message):
+            if message == point:
+                return None
+            return foo2
+        buf.seek(0, 0)
+        out = StringIO()
+        for i in xrange(4):
+            msgs.relay(buf, out, rewrite)
+        out.seek(0, 0)
+        for i in xrange(3):
+            value = foo2.decode(out)
+            self.assertEqual(i, value['id'])
+            self.assertEqual(30000, len(value['chunks']))
+        self.assertEqual('', out.read())
+
+        buf.seek(0, 0)
+        self.assertEqual(foo, foo.relay(buf, StringIO()))
+        self.assertRaises(sendlib.SendlibError, point.relay, buf, StringIO())
+        self.assertRaises(sendlib.SendlibError, foo.relay,
+                          StringIO(original[:100]), StringIO())
+
+        # a message may only be rewritten as one of the same layout
+        buf.seek(0, 0)
+        out = StringIO()
+        self.assertRaises(sendlib.SendlibError, msgs.relay, buf, out,
+                          lambda message: point)
+        self.assertEqual('', out.getvalue())
+
+    def test_validation_levels(self):
+        definition = """
+        (point, 1):
+         - x: int
+         - y: float or nil
+
+        (point, 2):
+         - x: int
+         - y: float or nil
+         - z: int = 0
+
+        (foo, 1):
+         - id: int
+         - name: str or nil
+         - flag: bool
+         - origin: msg (point, 1)
+         - path: many msg (point, 1) or nil
+         - tags: many str
+         - body: data
+        """
+        msgs = sendlib.parse(definition)
+        foo = msgs[('foo', 1)]
+        point = msgs[('point', 1)]
+        value = {'id': 1, 'name': u'caf\xe9', 'flag': True,
+                 'origin': {'x': 1, 'y': 2.5},
+                 'path': [{'x': 2L, 'y': None}],
+                 'tags': [u'a', 'bc'], 'body': StringIO('body')}
+
+        buf = StringIO()
+        foo.encode(buf, value)
+        expected = buf.getvalue()
+        for level in ('full', 'cheap', 'trusted'):
+            buf = StringIO()
+            value['body'].seek(0, 0)
+            foo.encode(buf, value, validate=level)
+            self.assertEqual(expected, buf.getvalue())
+            buf.seek(0, 0)
+            decoded = foo.decode(buf, validate=level)
+            self.assertEqual(u'caf\xe9', decoded['name'])
+            self.assertEqual(2, decoded['path'][0]['x'])
+            self.assertEqual('body', decoded['body'])
+
+        self.assertRaises(sendlib.SendlibError, foo.writer, StringIO(), 'x')
+        self.assertRaises(sendlib.SendlibError, foo.reader, StringIO(),
+                          validate='x')
+
+        # cheap writes still check field order and types
+        writer = foo.writer(StringIO(), validate='cheap')
+        self.assertRaises(sendlib.SendlibError, writer.write, 'name', None)
+        self.assertRaises(sendlib.SendlibError, writer.write, 'id', 'one')
+        writer.write('id', 1)
+        self.assertRaises(sendlib.SendlibError, writer.write, 'name', 1.0)
+
+        # trusted writes check nothing
+        buf = StringIO()
+        writer = foo.writer(buf, validate='trusted')
+        writer.write('id', 'one')
+        self.assertEqual('S\x00\x00\x00\x03one', buf.getvalue()[-8:])
+
+        # cheap reads compare the header, and read other versions
+        buf = StringIO()
+        point.encode(buf, {'x': 1, 'y': None})
+        buf.seek(0, 0)
+        reader = foo.reader(buf, validate='cheap')
+        self.assertRaises(sendlib.SendlibError, reader.read, 'id')
+        buf.seek(0, 0)
+        self.assertEqual({'x': 1, 'y': None, 'z': 0},
+                         msgs[('point', 2)].decode(buf, validate='cheap'))
+
+        # but check only the first element of lists
+        buf = StringIO()
+        value['body'].seek(0, 0)
+        foo.encode(buf, dict(value, tags=['a', 'zz']))
+        buf = StringIO(buf.getvalue().replace('S\x00\x00\x00\x02zz',
+                                              'I\x00\x00\x00\x02'))
+        self.assertRaises(sendlib.SendlibError, foo.decode, buf)
+        buf.seek(0, 0)
+        self.assertEqual(['a', 2], foo.decode(buf, validate='cheap')['tags'])
+
+        # trusted reads skip the header
+        buf = StringIO(expected)
+        reader = foo.reader(buf, validate='trusted')
+        self.assertEqual(1, reader.read('id'))
+        self.assertEqual(u'caf\xe9', reader.read('nothing'))
+        buf = StringIO('M' + 'X' * 100)
+        reader = foo.reader(buf, validate='trusted')
+        self.assertRaises(sendlib.SendlibError, reader.read, 'id')
+
+    def test_reset_and_release(self):
+        msgs = sendlib.parse("""
+        (point, 1):
+         - x: int
+         - y: int
+
+        (line, 1):
+         - start: msg (point, 1)
+         - end: msg (point, 1)
+        """)
+        line = msgs[('line', 1)]
+        point = msgs[('point', 1)]
+
+        buf = StringIO()
+        writer = point.writer(buf)
+        writer.write('x', 1)
+        writer.reset()
+        writer.write('x', 2)
+        writer.write('y', 3)
+        other = StringIO()
+        writer.reset(other)
+        writer.write('x', 4)
+        writer.write('y', 5)
+        expected = StringIO()
+        point.encode(expected, {'x': 4, 'y': 5})
+        self.assertEqual(expected.getvalue(), other.getvalue())
+
+        buf.seek(0, 0)
+        reader = point.reader(buf)
+        self.assertEqual(1, reader.read('x'))
+        reader.reset(other)
+        other.seek(0, 0)
+        self.assertEqual(4, reader.read('x'))
+        self.assertEqual(5, reader.read('y'))
+
+        # released objects are reused
+        point.release(writer)
+        point.release(reader)
+        self.assertTrue(writer is point.writer(buf))
+        self.assertTrue(reader is point.reader(buf))
+        self.assertFalse(writer is point.writer(buf))
+        self.assertRaises(sendlib.SendlibError, line.release, writer)
+
+        # nested writers and readers come from, and go back to, the pool
+        buf = StringIO()
+        for i in xrange(3):
+            line.encode(buf, {'start': {'x': i, 'y': i}, 'end': {'x': 0, 'y': 0}})
+        self.assertEqual(1, len(point._writers))
+        buf.seek(0, 0)
+        for i in xrange(3):
+            value = line.decode(buf)
+            self.assertEqual({'x': i, 'y': i}, value['start'])
+            self.assertEqual({'x': 0, 'y': 0}, value['end'])
+        self.assertEqual(1, len(point._readers))
+        self.assertEqual(1, len(line._readers))
+
+    def test_deep_nesting(self):
+        msgs = sendlib.parse("""
+        (node, 1):
+         - depth: int
+         - child: msg (node, 1) or nil
+         - leaves: many msg (node, 1) or nil
+        """)
+        node = msgs[('node', 1)]
+        Node = node.record_class()
+
+        # deeper than the interpreter's recursion limit
+        depth = sys.getrecursionlimit() * 2
+        value = None
+        for i in reversed(xrange(depth)):
+            value = {'depth': i, 'child': value,
+                     'leaves': [{'depth': i}, Node(i, None, [])]}
+        buf = StringIO()
+        node.encode(buf, value)
+        for record in (False, True):
+            buf.seek(0, 0)
+            value = node.decode(buf, record=record)
+            for i in xrange(depth):
+                self.assertEqual(i, value.get('depth'))
+                self.assertEqual(2, len(value.get('leaves')))
+                self.assertEqual(i, value.get('leaves')[1].get('depth'))
+                value = value.get('child')
+            self.assertEqual(None, value)
+            self.assertEqual('', buf.read())
+
+    def test_encode_cache(self):
+        msgs = sendlib.parse("""
+        (config, 1):
+         - name: str
+         - level: int
+
+        (note, 1):
+         - id: int
+         - config: msg (config, 1)
+         - history: many msg (config, 1) or nil
+        """)
+        note = msgs[('note', 1)]
+        config = msgs[('config', 1)]
+        shared = {'name': u'main', 'level': 3}
+        other = config.record_class()(u'other', 4)
+        values = [{'id': i, 'config': shared,
+                   'history': [other, {'name': u'x', 'level': i}, shared]}
+                  for i in xrange(5)]
+
+        expected = StringIO()
+        for value in values:
+            note.encode(expected, value)
+
+        cache = sendlib.EncodeCache(messages=[config])
+        buf = StringIO()
+        for value in values:
+            note.encode(buf, value, cache=cache)
+        self.assertEqual(expected.getvalue(), buf.getvalue())
+        # shared and other miss once each, each dict in history once
+        self.assertEqual(7, cache.misses)
+        self.assertEqual(13, cache.hits)
+        self.assertEqual(7, len(cache))
+        self.assertAlmostEqual(13 / 20.0, cache.hit_rate())
+
+        # whole messages are cached too
+        cache = sendlib.EncodeCache()
+        buf = StringIO()
+        for i in xrange(3):
+            note.encode(buf, values[0], cache=cache)
+        self.assertEqual(expected.getvalue()[:len(buf.getvalue()) / 3] * 3,
+                         buf.getvalue())
+        self.assertEqual((3, 4), (cache.hits, cache.misses))
+
+        # the least recently used are evicted to stay within max_size
+        size = len(cache._entries[(config, id(shared))][1])
+        cache = sendlib.EncodeCache(max_size=size * 2, messages=[config])
+        buf = StringIO()
+        note.encode(buf, values[0], cache=cache)
+        self.assertEqual(2, cache.evictions)
+        self.assertTrue(cache.size <= size * 2)
+        buf = StringIO()
+        note.encode(buf, values[1], cache=cache)
+        self.assertEqual(expected.getvalue()[len(buf.getvalue()):][
+            :len(buf.getvalue())], buf.getvalue())
+        cache.clear()
+        self.assertEqual((0, 0), (len(cache), cache.size))
+
+    def test_fixed_layout(self):
+        msgs = sendlib.parse("""
+        (metric, 1):
+         - count: int
+         - mean: float
+         - ok: bool
+         - max: int = 7
+
+        (sample, 1):
+         - name: str
+         - x: int
+         - y: int
+         - label: str or nil
+         - on: bool
+         - metric: msg (metric, 1)
+        """)
+        metric = msgs[('metric', 1)]
+        sample = msgs[('sample', 1)]
+
+        buf = StringIO()
+        writer = metric.writer(buf)
+        writer.write('count', 3)
+        writer.write('mean', 1.5)
+        writer.write('ok', False)
+        writer.write('max', 7)
+        expected = buf.getvalue()
+        buf = StringIO()
+        metric.encode(buf, {'count': 3, 'mean': 1.5, 'ok': False})
+        self.assertEqual(expected, buf.getvalue())
+        for level in ('full', 'cheap', 'trusted'):
+            buf.seek(0, 0)
+            self.assertEqual({'count': 3, 'mean': 1.5, 'ok': False, 'max': 7},
+                             metric.decode(buf, validate=level))
+        buf.seek(0, 0)
+        self.assertEqual({'mean': 1.5}, metric.decode(buf, fields=['mean']))
+
+        value = {'name': u'a', 'x': 1L, 'y': 2, 'on': True,
+                 'metric': {'count': 1, 'mean': 0.0, 'ok': True, 'max': 2}}
+        buf = StringIO()
+        sample.encode(buf, value)
+        buf.seek(0, 0)
+        reader = sample.reader(buf)
+        self.assertEqual(u'a', reader.read('name'))
+        self.assertEqual(1, reader.read('x'))
+        self.assertEqual(2, reader.read('y'))
+        self.assertEqual(None, reader.read('label'))
+        self.assertEqual(True, reader.read('on'))
+        nested = reader.read('metric')
+        self.assertEqual([1, 0.0, True, 2],
+                         [nested.read(name)
+                          for name in ('count', 'mean', 'ok', 'max')])
+        buf.seek(0, 0)
+        value['label'] = None
+        self.assertEqual(value, sample.decode(buf))
+
+        # values of other types fall back to (and fail) the field checks
+        self.assertRaises(sendlib.SendlibError, metric.encode, StringIO(),
+                          {'count': 1.0, 'mean': 1.5, 'ok': False})
+        self.assertRaises(sendlib.SendlibError, metric.encode, StringIO(),
+                          {'count': True, 'mean': 1.5, 'ok': False})
+
+        # prefixes are all checked
+        bad = expected.replace('Bf', 'Nf')
+        self.assertRaises(sendlib.SendlibError, metric.decode, StringIO(bad))
+        self.assertRaises(sendlib.SendlibError, metric.decode,
+                          StringIO(expected[:-1]))
+
+    def test_empty_message(self):
+        msgs = sendlib.parse("""
+        (ping, 1):
+
+        (pong, 1):
+         - ping: msg (ping, 1)
+         - pings: many msg (ping, 1)
+        """)
+        ping = msgs[('ping', 1)]
+        pong = msgs[('pong', 1)]
+        for level in ('full', 'cheap', 'trusted'):
+            buf = StringIO()
+            ping.encode(buf, {}, validate=level)
+            pong.encode(buf, {'ping': {}, 'pings': [{}, {}]}, validate=level)
+            buf.seek(0, 0)
+            self.assertEqual({}, ping.decode(buf, validate=level))
+            self.assertEqual({'ping': {}, 'pings': [{}, {}]},
+                             pong.decode(buf, validate=level))
+            self.assertEqual('', buf.read())
+
+    def test_versions_nested_last(self):
+        msgs = sendlib.parse("""
+        (pt, 1):
+         - x: int
+
+        (auth, 1):
+         - user: str
+         - where: msg (pt, 1)
+         - legacy: int
+         - pts: many msg (pt, 1)
+
+        (auth, 2):
+         - user: str
+         - where: msg (pt, 1)
+
+        (route, 1):
+         - stops: many msg (pt, 1)
+         - legacy: int
+
+        (route, 2):
+         - stops: many msg (pt, 1)
+        """)
+        auth1 = msgs[('auth', 1)]
+        auth2 = msgs[('auth', 2)]
+        route1 = msgs[('route', 1)]
+        route2 = msgs[('route', 2)]
+
+        buf = StringIO()
+        for i in xrange(2):
+            auth1.encode(buf, {'user': u'u', 'where': {'x': i}, 'legacy': 7,
+                               'pts': [{'x': 8}, {'x': 9}]})
+        route1.encode(buf, {'stops': [{'x': 1}, {'x': 2}], 'legacy': 7})
+        auth1.encode(buf, {'user': u'v', 'where': {'x': 5}, 'legacy': 7,
+                           'pts': []})
+
+        # the dropped fields follow the nested message, so are
+        # skipped only once it is read
+        buf.seek(0, 0)
+        reader = auth2.reader(buf)
+        self.assertEqual(u'u', reader.read('user'))
+        self.assertEqual(0, reader.read('where').read('x'))
+        self.assertEqual({'user': u'u', 'where': {'x': 1}}, auth2.decode(buf))
+        reader = route2.reader(buf)
+        self.assertEqual([1, 2], [p.read('x') for p in reader.read('stops')])
+        self.assertEqual({'user': u'v', 'where': {'x': 5}}, auth2.decode(buf))
+        self.assertEqual('', buf.read())
 
 
 if __name__ == '__main__':